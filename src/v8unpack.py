@@ -1,15 +1,38 @@
 import argparse
+import array
 import binascii
 import codecs
-import itertools
+import collections
+import contextlib
+import cProfile
+import difflib
+import hashlib
+import io
+import json
+import locale
+import marshal
+import math
+import operator
 import os
+import pstats
+import queue
+import re
+import shlex
 import shutil
+import sqlite3
+import struct
+import sys
 import tempfile
+import threading
+import time
+import tracemalloc
+import weakref
 from distutils.dir_util import copy_tree
 import uuid
 import subprocess
 import pathlib
-from multiprocessing import Pool
+import zlib
+from multiprocessing import Pool, current_process, shared_memory
 from multiprocessing.dummy import Pool as ThreadPool
 
 import pandas
@@ -20,6 +43,103 @@ import pandas
 #
 #########################################
 
+# Строки лога конфигуратора, после которых ждать нечего: процесс
+# останавливается сразу. Дополнительные регулярные выражения (через
+# перевод строки) передаются через окружение
+
+DESIGNER_FATAL_ENV = 'UNPACKPY_DESIGNER_FATAL'
+DESIGNER_FATAL = [
+    'формата потока',
+    'Информационная база не обнаружена',
+    'Нарушение целостности',
+]
+DESIGNER_POLL = 0.2
+
+
+def designerFatalPatterns():
+
+    patterns = list(DESIGNER_FATAL)
+    patterns.extend(x for x in
+                    os.environ.get(DESIGNER_FATAL_ENV, '').split('\n') if x)
+
+    return [re.compile(pattern) for pattern in patterns]
+
+
+class DesignerError(Exception):
+    '''Ошибка конфигуратора: операция, код возврата (None - процесс
+       остановлен по строке лога), строка лога, по которой он
+       остановлен, и весь прочитанный лог
+    '''
+
+    def __init__(self, operation, returncode, log, line=None):
+
+        self.operation = operation
+        self.returncode = returncode
+        self.log = log
+        self.line = line
+
+        if line is not None:
+            message = f'{operation}: конфигуратор остановлен, в логе "{line}"'
+        else:
+            message = f'{operation}: конфигуратор завершился с кодом' \
+                      f' {returncode}'
+
+        super().__init__(f'''{message} \n
+                         Подробности: {log}''')
+
+
+class DesignerLog:
+
+    # Чтение лога /Out по мере записи: только целые строки,
+    # кодировка по BOM, без BOM - кодировка системы
+
+    def __init__(self, path):
+        self.path = path
+        self.lines = []
+        self._position = 0
+        self._decoder = None
+        self._head = b''
+        self._pending = ''
+
+    def read(self, final=False):
+
+        try:
+            with open(self.path, 'rb') as file:
+                file.seek(self._position)
+                data = file.read()
+        except OSError:
+            data = b''
+        self._position = self._position + len(data)
+
+        # Кодировку выбираем, когда прочитано не меньше 3 байт (длина
+        # BOM utf-8) или лог дописан: по 1-2 байтам BOM не распознать
+
+        if self._decoder is None:
+            data = self._head + data
+            if len(data) < 3 and not final:
+                self._head = data
+                return []
+            self._head = b''
+            if data[0:3] == codecs.BOM_UTF8:
+                encoding = 'utf-8-sig'
+            elif data[0:2] == codecs.BOM_UTF16_LE:
+                encoding = 'utf-16'
+            else:
+                encoding = locale.getpreferredencoding(False)
+            self._decoder = codecs.getincrementaldecoder(encoding)('replace')
+
+        text = self._pending + self._decoder.decode(data, final)
+        lines = text.split('\n')
+        self._pending = '' if final else lines.pop()
+        lines = [line.rstrip('\r') for line in lines if line.strip()]
+
+        self.lines.extend(lines)
+        return lines
+
+    def text(self):
+
+        return '\n'.join(self.lines)
+
 
 class EnterpriseManager:
 
@@ -43,6 +163,7 @@ class EnterpriseManager:
             self.Version = version
 
         self.BinPath = self._VersionsBinPath.get(self.Version)
+        runSet('enterpriseVersion', self.Version)
 
     def _sortVersions(self, version):
 
@@ -93,12 +214,50 @@ class EnterpriseManager:
 
         self._Versions.sort(key=self._sortVersions)
 
+    def _runDesigner(self, arguments, log, operation):
+        '''Запуск 1cv8 с аргументами командной строки arguments (строка).
+           Лог log выводится по мере записи, при строке из
+           designerFatalPatterns процесс останавливается сразу.
+           Возвращает текст лога, при ошибке - DesignerError
+        '''
+
+        command = f'"{os.path.normpath(self.BinPath)}" {arguments}'
+        if os.name != 'nt':
+            command = shlex.split(command)
+
+        fatal = designerFatalPatterns()
+        tail = DesignerLog(log)
+        process = subprocess.Popen(command)
+
+        try:
+            while True:
+                finished = process.poll() is not None
+                for line in tail.read(final=finished):
+                    print(f'..{operation}: {line}')
+                    if any(pattern.search(line) for pattern in fatal):
+                        process.kill()
+                        process.wait()
+                        raise DesignerError(operation, None, tail.text(), line)
+                if finished:
+                    break
+                time.sleep(DESIGNER_POLL)
+        except BaseException:
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+            raise
+
+        if process.returncode != 0:
+            raise DesignerError(operation, process.returncode, tail.text())
+
+        return tail.text()
+
     def epfDump(self, epf, xml):
 
         # Подготовка окружения
 
-        with tempfile.TemporaryDirectory() as tempdir:
-            INFOBASE = self.createTempFileDB(tempdir)
+        with scratch().directory('dump-') as tempdir, \
+                self.tempInfobase() as INFOBASE:
             LOGDESIGNER = os.path.join(tempdir,
                                        'DESIGNER.LOG')
             LOGDump = os.path.join(tempdir,
@@ -115,64 +274,42 @@ class EnterpriseManager:
 
             # Выгрузка обработки в файлы
 
-            Enterprise = os.path.normpath(self.BinPath)
             INFOBASE = os.path.normpath(INFOBASE)
             LOGDESIGNER = os.path.normpath(LOGDESIGNER)
             xml = os.path.normpath(xml)
             epf = os.path.normpath(epf)
             LOGDump = os.path.normpath(LOGDump)
 
-            cmdStr = f'""{Enterprise}" ' +\
-                     f'DESIGNER /F "{INFOBASE}" /Out "{LOGDESIGNER}" ' +\
+            arguments = f'DESIGNER /F "{INFOBASE}" /Out "{LOGDESIGNER}" ' +\
                 '/WA+ /DisableStartupMessages /DisableStartupDialogs /DumpExternalDataProcessorOrReportToFiles ' +\
-                f'"{xml}" "{epf}" -Format {formatDump} /Out "{LOGDump}""'
+                f'"{xml}" "{epf}" -Format {formatDump} /Out "{LOGDump}"'
 
-            result = os.system(cmdStr)
+            with runStage('designer.dump'):
+                self._runDesigner(arguments, LOGDump,
+                                  f'Выгрузка {os.path.basename(epf)}')
 
-            # Исключения
-
-            if os.path.exists(LOGDump):
-                logtext = open(LOGDump, 'r').read()
-            else:
-                logtext = ''
-
-            if result != 0:
-                raise Exception(f'''Не удалось выгрузить обработку в файлы \n
-                                 Подробности: {logtext}''')
-            else:
-                if logtext.find('формата потока') != -1:
-                    raise Exception(logtext)
+    def epfBuid(self, xml, epf, infobase=None):
 
-    def epfBuid(self, xml, epf):
+        if infobase is None:
+            infobase = self.tempInfobase()
+        else:
+            infobase = contextlib.nullcontext(infobase)
 
-        with tempfile.TemporaryDirectory() as tempdir:
-            INFOBASE = self.createTempFileDB(tempdir)
+        with scratch().directory('build-') as tempdir, infobase as INFOBASE:
             LOGDESIGNER = tempdir + '/DESIGNER.LOG'
             LOGLoad = tempdir + '/LoadExternalDataProcessorOrReportFromFiles.LOG'
 
             # Загрузка обработки из файлов
 
-            cmdStr = f'""{self.BinPath}" DESIGNER /F "{INFOBASE}" /Out "{LOGDESIGNER}" ' + \
+            arguments = f'DESIGNER /F "{INFOBASE}" /Out "{LOGDESIGNER}" ' + \
                 '/WA+ /DisableStartupMessages /DisableStartupDialogs ' + \
                 '/LoadExternalDataProcessorOrReportFromFiles ' + \
                 f'"{os.path.normpath(xml)}" "{os.path.normpath(epf)}" ' + \
-                f'/Out "{LOGLoad}""'
-
-            result = os.system(cmdStr)
-
-            # Исключения
-
-            if os.path.exists(LOGLoad):
-                logtext = open(LOGLoad, 'r').read()
-            else:
-                logtext = ''
+                f'/Out "{LOGLoad}"'
 
-            if result != 0:
-                raise Exception(f'''Не удалось выгрузить обработку в файлы \n
-                                 Подробности: {logtext}''')
-            else:
-                if logtext.find('формата потока') != -1:
-                    raise Exception(logtext)
+            with runStage('designer.load'):
+                self._runDesigner(arguments, LOGLoad,
+                                  f'Загрузка {os.path.basename(epf)}')
 
     def getEpfDumpRoot(self, xml):
 
@@ -182,6 +319,30 @@ class EnterpriseManager:
             os.path.splitext(basename)[0])
         return root
 
+    @contextlib.contextmanager
+    def tempInfobase(self):
+        '''Пустая файловая база для конфигуратора. С --scratch-keep
+           база сохраняется и используется в следующих запусках
+        '''
+
+        with scratch().directory('infobase-', SCRATCH_INFOBASE_SIZE,
+                                 f'infobase {self.Version}') as tempdir:
+
+            # Признак того, что база создана до конца
+
+            ready = os.path.join(tempdir, 'infobase.ready')
+            if not os.path.exists(ready):
+                for name in os.listdir(tempdir):
+                    path = os.path.join(tempdir, name)
+                    if os.path.isdir(path):
+                        shutil.rmtree(path)
+                    else:
+                        os.remove(path)
+                self.createTempFileDB(tempdir)
+                open(ready, 'w').close()
+
+            yield os.path.normpath(tempdir)
+
     def createTempFileDB(self, tempdir):
 
         INFOBASE = os.path.normpath(tempdir)
@@ -189,16 +350,10 @@ class EnterpriseManager:
 
         # Создание информационной базы
 
-        cmdStr = f'""{self.BinPath}" ' + \
-                 f'CREATEINFOBASE File="{INFOBASE}" /Out "{LOG}""'
-        result = os.system(cmdStr)
-
-        if result != 0:
-            logtext = ''
-            if os.path.exists(LOG):
-                logtext = open(LOG, 'r').read()
-            raise EnvironmentError(f'''Не удалось создать информационную базу \n
-                                    Подробности: {logtext}''')
+        arguments = f'CREATEINFOBASE File="{INFOBASE}" /Out "{LOG}"'
+        with runStage('designer.infobase'):
+            self._runDesigner(arguments, LOG,
+                              'Создание информационной базы')
 
         return INFOBASE
 
@@ -209,15 +364,44 @@ class EnterpriseManager:
 #########################################
 
 
+class _LazyBranch(dict):
+
+    # Ветка ленивой формы: пока к строкам не обратились,
+    # хранится только положение ветки в исходном тексте
+
+    def __init__(self, form, start, end, parent=None):
+        super().__init__(parent=parent)
+        self.span = (start, end)
+        self._form = form
+
+    def __missing__(self, key):
+
+        if key != 'rows':
+            raise KeyError(key)
+
+        rows = self._form._materialize(self)
+        self['rows'] = rows
+        return rows
+
+
 class Form:
 
-    def __init__(self, formDataPath):
+    def __init__(self, formDataPath, lazy=False, cache=True):
         self._formDataPath = formDataPath
-        self._formDatalines = []
-        self._formDataRows = []
         self._formDataTree = None
-        self._formDatalevel = 0
         self._allformDataArray = []
+        self._lazy = lazy
+        self._cache = cache
+        self._lazyText = None
+        self._lazyKind = None
+        self._lazyCloseOf = None
+
+        # Последний записанный (или лениво прочитанный) файл формы и
+        # положение веток в нем: id ветки -> (ветка, родитель, начало
+        # относительно начала родителя, длина, строки ветки при записи)
+
+        self._output = None
+        self._spans = {}
 
     def _branch(self, parent=None):
 
@@ -232,160 +416,8 @@ class Form:
 
         return branch
 
-    def _readRows(self, rowNumber):
-
-        line = self._formDatalines[rowNumber]
-        line = line.replace('\n', '')
-        line = line.replace('\r', '')
-        line = line.replace('\t', '')
-
-        if line == '':
-            return
-
-        rowData = self._readLine(line)
-
-        self._formDataRows[rowNumber] = rowData
-
-    def _readLine(self, line):
-
-        tree = self._branch()
-        lastBranch = self._formDataLineToTree(line, tree)
-
-        rowData = {
-            'branch': tree,
-            'lastBranch': lastBranch,
-            'openTag': line[0] == '{',
-            'lastPropertyTag': line[-1] != ','
-        }
-
-        return rowData
-
-    def _formDataLineToTree(self, line, tree):
-
-        i = len(line)
-
-        for symbol in reversed(line):
-
-            if symbol == '}':
-
-                newBranch = self._branch(tree)
-                newline = line[0:i-1]
-                lastBranch = self._formDataLineToTree(newline, newBranch)
-
-                self._appendRow(tree['rows'], newBranch)
-                return lastBranch
-
-            elif symbol == '{':
-                return tree
-            elif symbol == ',':
-                tree['rows'].append(None)
-            else:
-                self._setRow(tree['rows'], symbol)
-
-            i = i-1
-
-        return tree
-
-    def _appendRow(self, rows, row):
-
-        if len(rows) == 0:
-            rows.append(row)
-        elif rows[-1] is None:
-            rows[-1] = row
-        else:
-            rows.append(row)
-
-    def _setRow(self, rows, value):
-
-        if len(rows) == 0:
-            rows.append(value)
-        elif rows[-1] is None:
-            rows[-1] = value
-        else:
-            rows[-1] = rows[-1] + value
-
-    def _buildTree(self):
-
-        currentBranch = self._formDataRows[-1]['lastBranch']['parent']
-
-        for dataRow in reversed(self._formDataRows):
-
-            if dataRow is None:
-                continue
-
-            if id(self._formDataRows[-1]) == id(dataRow):
-                continue
-
-            # Запись
-
-            dataRow['branch']['parent'] = currentBranch
-            for row in dataRow['branch']['rows']:
-                if type(row) == dict:
-                    row['parent'] = currentBranch
-                currentBranch['rows'].append(row)
+    def _normalizeControlPanel(self, ControlPanelData):
 
-            # Выбор новой текущей позиции
-
-            newCurrentBranch = dataRow['lastBranch']
-
-            if (newCurrentBranch is None or
-                    dataRow['lastBranch'] == dataRow['branch']):
-
-                newCurrentBranch = currentBranch
-
-            if dataRow['openTag']:
-
-                newCurrentBranch = newCurrentBranch['parent']
-
-            currentBranch = newCurrentBranch
-
-        # Инвертируем результат
-
-        for array in self._allformDataArray:
-            array.reverse()
-            for i in range(len(array)):
-                if type(array[i]) == str:
-                    array[i] = array[i][::-1]
-
-        if currentBranch is None:
-            # Исключение для чтения "красивого формата"
-            # т.к. читалка говно и формат говно
-            # то и исключение говно
-            self._formDataTree = dataRow['lastBranch']['parent']
-            del self._formDataTree['rows'][-1]
-        else:
-            self._formDataTree = currentBranch['rows'][0]
-
-    def _findInFormDataArray(self, value):
-
-        result = []
-
-        for i in range(len(self._allformDataArray)):
-            array = self._allformDataArray[i]
-            for j in range(len(array)):
-                if array[j] == value:
-                    try:
-                        index = result.index(i)
-                    except ValueError:
-                        index = None
-                    if index is None:
-                        result.append(i)
-                    break
-
-        return result
-
-    def _findFormDataArrayByID(self, valueid):
-
-        for i in range(len(self._allformDataArray)):
-            array = self._allformDataArray[i]
-            if id(array) == valueid:
-                return array
-
-        return None
-
-    def _removeShitFromControlPanel(self, address):
-
-        ControlPanelData = self._allformDataArray[address]
         if len(ControlPanelData) == 2:
             return
 
@@ -405,9 +437,7 @@ class Form:
         if len(ControlPanel['itemParameters']) == 0:
             return
 
-        itemsDataArray = self._findFormDataArrayByID(
-            ControlPanel['itemsDataId']
-        )
+        itemsDataArray = ControlPanel['itemsData']
 
         # Сгенерируем новые ID
 
@@ -427,8 +457,8 @@ class Form:
             parm['newID'] = item['newID']
             parm['branch'] = itemsDataArray[parm['index']]
             parm['itemindex'] = item['index']
-            parm['itemGroupDataId'] = item['groupDataId']
-            parm['itemGroupDataIdIndex'] = item['groupDataIdIndex']
+            parm['itemGroupData'] = item['groupData']
+            parm['itemGroupDataIndex'] = item['groupDataIndex']
 
         itemParams = pandas.DataFrame(ControlPanel['itemParameters'])
         itemParamsSorted = itemParams.sort_values('itemindex').to_dict('r')
@@ -441,155 +471,502 @@ class Form:
         for j in range(begin, end + 1):
 
             i = i + 1
-            paramDataId = itemParamsSorted[i]['dataid']
+            paramDataArray = itemParamsSorted[i]['data']
             paramNewUUID = itemParamsSorted[i]['newID']
             paramBranch = itemParamsSorted[i]['branch']
-            itemGroupDataId = itemParamsSorted[i]['itemGroupDataId']
-            itemGroupDataIdIndex = itemParamsSorted[i]['itemGroupDataIdIndex']
+            itemGroupDataArray = itemParamsSorted[i]['itemGroupData']
+            itemGroupDataIndex = itemParamsSorted[i]['itemGroupDataIndex']
 
             # изменение UUID
 
-            paramDataArray = self._findFormDataArrayByID(paramDataId)
             paramDataArray[1] = paramNewUUID
-            itemGroupDataArray = self._findFormDataArrayByID(itemGroupDataId)
-            itemGroupDataArray[itemGroupDataIdIndex] = paramNewUUID
+            itemGroupDataArray[itemGroupDataIndex] = paramNewUUID
 
             # Перестановка
 
             itemsDataArray[j] = paramBranch
 
-    def _writeBranch(self, branch, file):
+    def _readLazy(self):
+
+        # Читаем только текст и парные скобки, ветки разбираются по запросу
+
+        with open(self._formDataPath, 'rb') as file:
+            buffer = file.read()
+            stat = os.fstat(file.fileno())
+        text = buffer.decode('utf-8-sig')
+
+        # Парные скобки неизмененной формы берутся из кэша
+
+        cache = formCache() if self._cache else None
+        closeOf = None
+        if cache is not None:
+            digest = hashlib.sha1(buffer).hexdigest()
+            braces = cache.loadContent(digest, 'braces')
+            if braces is not None:
+                closeOf = dict(zip(array.array('I', braces[0]),
+                                   array.array('I', braces[1])))
+
+        if closeOf is None:
+            closeOf = {}
+            stack = []
+            for match in _formBracePattern.finditer(text):
+                if match.group() == '{':
+                    stack.append(match.start())
+                else:
+                    closeOf[stack.pop()] = match.start()
+
+            if cache is not None:
+                cache.saveContent(digest, 'braces', (
+                    array.array('I', closeOf.keys()).tobytes(),
+                    array.array('I', closeOf.values()).tobytes()))
 
-        if self._formDataTree == branch:
-            file.write('{')
+        self._lazyText = text
+        self._lazyCloseOf = closeOf
+        if formTextIsPretty(text):
+            self._lazyKind = 'pretty'
         else:
-            file.write('\r\n{')
+            self._lazyKind = 'compact'
+
+        start = text.index('{')
+        self._formDataTree = _LazyBranch(self, start, closeOf[start])
+
+        self._output = {'path': self._formDataPath,
+                        'stat': (stat.st_size, stat.st_mtime_ns),
+                        'text': text,
+                        'kind': self._lazyKind}
+        self._spans = {id(self._formDataTree): (self._formDataTree, None,
+                                                start, closeOf[start] - start,
+                                                None)}
+
+    def _materialize(self, branch):
+
+        text = self._lazyText
+        start, end = branch.span
+
+        rows = []
+        self._allformDataArray.append(rows)
+
+        pos = start + 1
+        while True:
+            match = _formTokenPattern.search(text, pos, end)
+            if match is None:
+                break
+
+            token = match.group()
+            if token == '{':
+                close = self._lazyCloseOf[match.start()]
+                rows.append(_LazyBranch(self, match.start(), close, branch))
+                pos = close + 1
+            else:
+                value = token.replace('\t', '')
+                if value != '':
+                    rows.append(value)
+                pos = match.end()
+
+        # Строки ветки совпадают с записанными, пока их не изменили.
+        # Пока не было записи, дочерние ветки лежат в исходном тексте
 
-        countOfRow = len(branch['rows'])
-        isBase64 = False
+        record = self._spans.get(id(branch))
+        if record is not None and record[0] is branch:
+            self._spans[id(branch)] = record[:4] + (tuple(rows),)
 
-        if countOfRow > 0:
-            firstRow = branch['rows'][0]
-            if type(firstRow) == str and firstRow[0:8] == '#base64:':
-                isBase64 = True
+        if self._output is not None and self._output['text'] is text:
+            for row in rows:
+                if isinstance(row, _LazyBranch):
+                    self._spans[id(row)] = (row, branch, row.span[0] - start,
+                                            row.span[1] - row.span[0], None)
 
-        for i in range(countOfRow):
+        return rows
 
-            if i != 0 and i != countOfRow and not isBase64:
-                file.write(',')
+    def _lazyRowsAt(self, pos):
 
-            row = branch['rows'][i]
-            if type(row) == dict:
-                self._writeBranch(row, file)
-            elif isBase64:
-                self._formDatalevel = 0
-                file.write(row)
-                if i != countOfRow - 1:
-                    file.write('\r\r\n')
+        # Строки самой вложенной ветки, в которой находится позиция текста
+
+        branch = self._formDataTree
+        while True:
+            rows = branch['rows']
+            for row in rows:
+                if (isinstance(row, _LazyBranch) and
+                        row.span[0] < pos < row.span[1]):
+                    branch = row
+                    break
             else:
-                self._formDatalevel = 0
-                file.write(row)
+                return rows
 
-        if self._formDatalevel == 1:
-            self._formDatalevel = 0
-            file.write('\r\n')
+    def _emitBranch(self, branch, writer):
 
-        file.write('}')
-        self._formDatalevel = 1
+        if isinstance(branch, _LazyBranch) and 'rows' not in branch:
+            self._emitLazyBranch(branch, writer)
+            return
+
+        writer.open()
+        for row in branch['rows']:
+            if isinstance(row, dict):
+                self._emitBranch(row, writer)
+            else:
+                writer.value(row)
+        writer.close()
 
-    def _writeBranchPretty(self, branch, file):
+    def _emitLazyBranch(self, branch, writer):
 
-        self._formDatalevel = self._formDatalevel + 1
+        # Нетронутая ветка копируется из исходного текста как есть,
+        # если формат совпадает, иначе перекладывается по лексемам
 
-        otst = ''
+        # Ветка может принадлежать другой форме (например, при слиянии)
 
-        for i in range(self._formDatalevel):
-            if i != 0:
-                otst = otst + '\t'
+        form = branch._form
+        text = form._lazyText
+        start, end = branch.span
 
-        if self._formDataTree == branch:
-            file.write(otst+'{')
-        else:
-            file.write('\r\n'+otst+'{')
-
-        countOfRow = len(branch['rows'])
-        isBase64 = False
-
-        if countOfRow > 0:
-            firstRow = branch['rows'][0]
-            if type(firstRow) == str and firstRow[0:8] == '#base64:':
-                isBase64 = True
-
-        for i in range(countOfRow):
-
-            row = branch['rows'][i]
-            if type(row) == dict:
-                self._writeBranchPretty(row, file)
-                if i != countOfRow - 1:
-                    file.write(',')
-            elif isBase64:
-                if i == 0:
-                    file.write('\r\n'+otst+'\t')
-                file.write(row)
+        if writer.copyBranch(text, start, end, form._lazyKind):
+            return
+
+        for token in _formTokenPattern.findall(
+                text[start:end + 1].replace('\t', '')):
+            if token == '{':
+                writer.open()
+            elif token == '}':
+                writer.close()
+            else:
+                writer.value(token)
+
+    def _unchanged(self, branch, parent, memo):
+
+        # Ветка с тем же родителем, строки которой - те же объекты, что
+        # при прошлой записи, и все дочерние ветки не изменились.
+        # Нетронутая ленивая ветка не меняется
+
+        key = id(branch)
+        if key in memo:
+            return memo[key]
+
+        record = self._spans.get(key)
+        result = (record is not None and record[0] is branch and
+                  record[1] is parent)
+
+        if result and 'rows' in branch:
+            rows = branch['rows']
+            snapshot = record[4]
+            result = (snapshot is not None and len(rows) == len(snapshot) and
+                      all(map(operator.is_, rows, snapshot)))
+            if result:
+                result = all(self._unchanged(row, branch, memo)
+                             for row in rows if isinstance(row, dict))
+
+        memo[key] = result
+        return result
+
+    def _emitTracked(self, branch, parent, oldParentStart, newParentStart,
+                     emit):
+
+        # Запись ветки с запоминанием ее положения в emit['out'].
+        # Не изменившаяся ветка копируется из прошлой записи emit['text']
+
+        writer = emit['writer']
+        out = emit['out']
+        record = self._spans.get(id(branch))
+
+        oldStart = None
+        if (emit['text'] is not None and oldParentStart is not None and
+                record is not None and record[0] is branch and
+                record[1] is parent):
+            oldStart = oldParentStart + record[2]
+            length = record[3]
+            if (self._unchanged(branch, parent, emit['memo']) and
+                    writer.copyBranch(emit['text'], oldStart,
+                                      oldStart + length, emit['kind'])):
+                start = out.tell() - 1 - length
+                emit['spans'][id(branch)] = (branch, parent,
+                                             start - newParentStart, length,
+                                             record[4])
+                self._keepSpans(branch, emit['spans'])
+                return
+
+        if isinstance(branch, _LazyBranch) and 'rows' not in branch:
+            pos = out.tell()
+            self._emitLazyBranch(branch, writer)
+            end = out.tell() - 1
+            out.seek(pos)
+            start = pos + out.read(end + 1 - pos).index('{')
+            out.seek(0, io.SEEK_END)
+            emit['spans'][id(branch)] = (branch, parent,
+                                         start - newParentStart, end - start,
+                                         None)
+            return
+
+        writer.open()
+        start = out.tell() - 1
+        rows = branch['rows']
+        for row in rows:
+            if isinstance(row, dict):
+                self._emitTracked(row, branch, oldStart, start, emit)
+            else:
+                writer.value(row)
+        writer.close()
+        end = out.tell() - 1
+
+        emit['spans'][id(branch)] = (branch, parent, start - newParentStart,
+                                     end - start, tuple(rows))
+
+    def _keepSpans(self, branch, spans):
+
+        # Положения дочерних веток скопированной ветки не изменились
+        # относительно нее: переносим их записи из прошлой записи
+
+        stack = [branch]
+        while stack:
+            record = self._spans[id(stack.pop())]
+            for row in record[4] or ():
+                if not isinstance(row, dict):
+                    continue
+                child = self._spans.get(id(row))
+                if child is not None and child[0] is row:
+                    spans[id(row)] = child
+                    stack.append(row)
+
+    def _write(self, fileName, writerClass):
+
+        # Если файл не менялся после прошлой записи (или ленивого
+        # чтения), не изменившиеся ветки копируются из него, а на диск
+        # пишутся только отличающиеся блоки
+
+        output = self._output
+        if output is not None:
+            try:
+                stat = os.stat(fileName)
+            except OSError:
+                output = None
             else:
-                file.write('\r\n'+otst+'\t')
-                file.write(row)
-                if i != countOfRow - 1:
-                    file.write(',')
+                if (not _samePath(output['path'], fileName) or
+                        output['stat'] != (stat.st_size, stat.st_mtime_ns)):
+                    output = None
+
+        out = io.StringIO(newline='')
+        emit = {'writer': writerClass(out),
+                'out': out,
+                'text': None if output is None else output['text'],
+                'kind': None if output is None else output['kind'],
+                'memo': {},
+                'spans': {}}
+        self._emitTracked(self._formDataTree, None, 0, 0, emit)
+        text = out.getvalue()
+
+        if output is None:
+            with open(fileName, 'w', encoding='utf-8-sig',
+                      newline='') as file:
+                file.write(text)
+        else:
+            patchTextFile(fileName, output['text'], text)
 
-        file.write('\r\n'+otst+'}')
+        # Записи удаленных и замененных веток не переносятся
+        self._spans = emit['spans']
 
-        self._formDatalevel = self._formDatalevel - 1
+        stat = os.stat(fileName)
+        self._output = {'path': fileName,
+                        'stat': (stat.st_size, stat.st_mtime_ns),
+                        'text': text,
+                        'kind': writerClass.kind}
 
     def read(self):
 
-        # Чтение строк данных формы в ветки
+        if self._lazy:
+            self._readLazy()
+            return
 
-        file = codecs.open(self._formDataPath, 'r', encoding='utf-8-sig')
+        # Неизмененная форма берется из кэша разобранных деревьев
+
+        cache = formCache() if self._cache else None
+        if cache is not None:
+            table = cache.load(self._formDataPath)
+            if table is not None:
+                self._readTable(table)
+                return
+
+        with open(self._formDataPath, 'rb') as file:
+            buffer = file.read()
+            stat = os.fstat(file.fileno())
+
+        self.readBuffer(buffer)
+
+        if cache is not None:
+            table = self._table()
+            if table is not None:
+                cache.save(self._formDataPath, stat, buffer, table)
+
+    def _table(self):
+
+        # Плоская таблица веток в порядке обхода для кэша:
+        # все строки веток одной строкой через "\0" (на месте дочерних
+        # веток - пустые), число строк и дочерних веток каждой ветки,
+        # позиции и номера дочерних веток
+
+        index = {id(rows): i for i, rows in enumerate(self._allformDataArray)}
+
+        values = []
+        counts = array.array('I')
+        childCounts = array.array('I')
+        childPos = array.array('I')
+        childIndex = array.array('I')
+
+        for rows in self._allformDataArray:
+            counts.append(len(rows))
+            childCount = 0
+            for i, row in enumerate(rows):
+                if isinstance(row, dict):
+                    values.append('')
+                    childPos.append(i)
+                    childIndex.append(index[id(row['rows'])])
+                    childCount = childCount + 1
+                else:
+                    values.append(row)
+            childCounts.append(childCount)
 
-        self._formDatalines = file.readlines()
-        self._formDataRows = [None] * len(self._formDatalines)
+        joined = '\0'.join(values)
+        if joined.count('\0') != max(len(values) - 1, 0):
+            # Значение содержит "\0" - такую форму не кэшируем
+            return None
 
-        with ThreadPool() as pool:
-            pool.map(self._readRows, range(len(self._formDatalines)))
+        return (joined, counts.tobytes(), childCounts.tobytes(),
+                childPos.tobytes(), childIndex.tobytes())
 
-        # Объединение веток
+    def _readTable(self, table):
 
-        self._buildTree()
+        values, counts, childCounts, childPos, childIndex = table
 
-    def removeShit(self):
+        values = values.split('\0')
+        counts = array.array('I', counts)
+        childCounts = array.array('I', childCounts)
+        childPos = array.array('I', childPos)
+        childIndex = array.array('I', childIndex)
 
-        # Какое-то говно итерируется при каждом пересохранении
+        branches = [self._branch() for _ in counts]
 
-        Shit1 = self._formDataTree['rows'][1]['rows']
-        Shit1[10] = '1'
+        pos = 0
+        child = 0
+        for branch, count, childCount in zip(branches, counts, childCounts):
+            rows = branch['rows']
+            rows.extend(values[pos:pos + count])
+            pos = pos + count
 
-        # e69bf21d-97b2-4f37-86db-675aea9ec2c - командная панель
+            for i in range(child, child + childCount):
+                childBranch = branches[childIndex[i]]
+                childBranch['parent'] = branch
+                rows[childPos[i]] = childBranch
+            child = child + childCount
 
-        ControlPanelInDataArray = self._findInFormDataArray(
-            'e69bf21d-97b2-4f37-86db-675aea9ec2cb'
-        )
-        for address in ControlPanelInDataArray:
-            self._removeShitFromControlPanel(address)
+        self._formDataTree = branches[0]
 
-        # 6ff79819-710e-4145-97cd-1618da79e3e2 - кнопка в режим меню
+    def readBufferCached(self, buffer):
 
-        ControlPanelInDataArray = self._findInFormDataArray(
-            '6ff79819-710e-4145-97cd-1618da79e3e2'
-        )
-        for address in ControlPanelInDataArray:
-            self._removeShitFromControlPanel(address)
+        # Разбор буфера через кэш по содержимому: путь формы может быть
+        # временным (каталог выгрузки обработки)
+
+        cache = formCache() if self._cache else None
+        if cache is None:
+            self.readBuffer(buffer)
+            return
+
+        digest = hashlib.sha1(buffer).hexdigest()
+        table = cache.loadContent(digest, 'tree')
+        if table is not None:
+            self._readTable(table)
+            return
+
+        self.readBuffer(buffer)
+
+        table = self._table()
+        if table is not None:
+            cache.saveContent(digest, 'tree', table)
+
+    def readBuffer(self, buffer):
+
+        # Разбор формы из буфера (bytes, mmap, memoryview) за один проход:
+        # символы ищет регулярное выражение, Python работает на лексему
+
+        stack = []
+        start = 3 if buffer[0:3] == codecs.BOM_UTF8 else 0
+
+        for match in _formBytesTokenPattern.finditer(buffer, start):
+            token = match.group()
+            if token == b'{':
+                if stack:
+                    branch = self._branch(stack[-1])
+                    stack[-1]['rows'].append(branch)
+                else:
+                    branch = self._branch()
+                    self._formDataTree = branch
+                stack.append(branch)
+            elif token == b'}':
+                stack.pop()
+                if not stack:
+                    break
+            else:
+                value = token.replace(b'\t', b'')
+                if value:
+                    stack[-1]['rows'].append(value.decode('utf-8'))
+
+    def _applyRules(self, rows, rules):
+
+        for path, action in rules:
+            target = rows
+            if callable(action):
+                for index in path:
+                    target = target[index]['rows']
+                action(self, target)
+            else:
+                for index in path[:-1]:
+                    target = target[index]['rows']
+                target[path[-1]] = action
+
+    def _ruleBranches(self, rules):
+
+        # Ветки, первая строка которых - guid из правил. guid в другой
+        # строке ветки не подходит: раньше такая ветка все равно
+        # отбрасывалась или роняла formPanel. Ленивая форма разбирается
+        # только на пути к найденным guid
+
+        if not self._lazy:
+            return [rows for rows in self._allformDataArray
+                    if rows and isinstance(rows[0], str) and
+                    rows[0] in rules.table]
+
+        result = []
+        seen = set()
+
+        if rules.pattern is None:
+            return result
+
+        for match in rules.pattern.finditer(self._lazyText):
+            rows = self._lazyRowsAt(match.start())
+            if rows and rows[0] == match.group() and id(rows) not in seen:
+                seen.add(id(rows))
+                result.append(rows)
+
+        return result
+
+    def normalize(self, rules=None):
+
+        # Все правила применяются за один проход по веткам формы
+
+        if rules is None:
+            rules = FORM_RULES
+
+        self._applyRules(self._formDataTree['rows'], rules.table.get(None, []))
+
+        for rows in self._ruleBranches(rules):
+            self._applyRules(rows, rules.table[rows[0]])
+
+    def removeShit(self):
+
+        self.normalize()
 
     def write(self, fileName):
 
-        file = codecs.open(fileName, 'w+', 'utf-8-sig')
-        self._formDatalevel = 0
-        self._writeBranch(self._formDataTree, file)
+        self._write(fileName, FormCompactWriter)
 
     def writePretty(self, fileName):
-        file = codecs.open(fileName, 'w+', 'utf-8-sig')
-        self._formDatalevel = -1
-        self._writeBranchPretty(self._formDataTree, file)
+
+        self._write(fileName, FormPrettyWriter)
 
 
 def formPanel(data):
@@ -618,7 +995,7 @@ def formPanel(data):
         itemsParamData = itemsData[i]['rows']
         itemsParam = {}
         itemsParam['id'] = itemsParamData[1]
-        itemsParam['dataid'] = id(itemsParamData)
+        itemsParam['data'] = itemsParamData
         itemsParam['index'] = i
 
         itemParameters.append(itemsParam)
@@ -639,92 +1016,3114 @@ def formPanel(data):
             item['id'] = itemGroupData[i]
             item['name'] = itemGroupData[i+1]['rows'][1]
             item['name'] = item['name'].replace('"', '')
-            item['dataid'] = id(itemGroupData[i+1]['rows'])
+            item['data'] = itemGroupData[i+1]['rows']
 
-            item['groupDataId'] = id(itemGroupData)
-            item['groupDataIdIndex'] = i
+            item['groupData'] = itemGroupData
+            item['groupDataIndex'] = i
 
             items.append(item)
 
-    controlPanel['itemsDataId'] = id(itemsData)
+    controlPanel['itemsData'] = itemsData
     controlPanel['items'] = items
     controlPanel['itemParameters'] = itemParameters
 
     return controlPanel
 
+
+class FormRules:
+    '''Правила нормализации формы (guid ветки, путь, действие),
+       собранные в одну таблицу guid -> [(путь, действие)].
+       guid None - корень формы. Путь - номера строк от ветки,
+       действие - новое значение последней строки пути или
+       функция (form, rows) для ветки по пути
+    '''
+
+    def __init__(self, rules):
+
+        self.table = {}
+        for guid, path, action in rules:
+            self.table.setdefault(guid, []).append((tuple(path), action))
+
+        guids = [guid for guid in self.table if guid is not None]
+        if guids:
+            self.pattern = re.compile('|'.join(map(re.escape, guids)))
+        else:
+            self.pattern = None
+
+
+FORM_RULES = FormRules([
+
+    # Какое-то говно итерируется при каждом пересохранении
+
+    (None, (1, 10), '1'),
+
+    # e69bf21d-97b2-4f37-86db-675aea9ec2c - командная панель
+
+    ('e69bf21d-97b2-4f37-86db-675aea9ec2cb', (),
+     Form._normalizeControlPanel),
+
+    # 6ff79819-710e-4145-97cd-1618da79e3e2 - кнопка в режим меню
+
+    ('6ff79819-710e-4145-97cd-1618da79e3e2', (),
+     Form._normalizeControlPanel),
+])
+
 ##########################################
 #
-# Сборка разборка
+# Кэш разобранных форм
 #
 #########################################
 
+# Настройки передаются через окружение, чтобы их видели процессы пула
 
-def unpackForms(formpath, v8unpackpath):
+CACHE_DIR_ENV = 'UNPACKPY_CACHE_DIR'
+CACHE_SIZE_ENV = 'UNPACKPY_CACHE_SIZE'
 
-    v8unpackpath = os.path.normpath(v8unpackpath)
-    formpath = os.path.normpath(formpath)
-    formdir = os.path.dirname(formpath)
 
-    сmdStr = f'""{v8unpackpath}" -U "{formpath}" "{formdir}""'
-    result = os.system(сmdStr)
+def cacheDir():
 
-    if result != 0:
-        Exception(f'Не удалось разобрать форму {formpath}')
+    # Каталог кэша, None - кэш отключен
 
-    return result
+    path = os.environ.get(CACHE_DIR_ENV)
+    if path is None:
+        root = os.environ.get('LOCALAPPDATA',
+                              os.path.join(os.path.expanduser('~'), '.cache'))
+        path = os.path.join(root, 'unpackpy')
+    elif path == '':
+        return None
 
+    return path
 
-def afterUnpackForms(formPath):
-    '''Обработка исходников после сборки обработки,
-       удаление бинарников,
-       переименования
-    '''
 
-    formDirName = os.path.dirname(formPath)
-    moduleBsl = os.path.normpath(formDirName + '/module.bsl')
-    moduleData = os.path.normpath(formDirName + '/module.data')
+class FormCache:
 
-    os.rename(moduleData, moduleBsl)
+    # Таблицы веток форм (marshal), ключ - путь, размер, время
+    # изменения и хэш содержимого. Для ленивого чтения и разбора буфера
+    # ключ - только хэш содержимого: путь часто временный (каталог
+    # выгрузки, файлы драйверов git). Старые записи вытесняются по размеру
 
-    formDataPath = os.path.normpath(formDirName + '/form.data')
-    formPrettyDataPath = os.path.normpath(formDirName + '/form.prettydata')
+    VERSION = 1
 
-    newForm = Form(formDataPath)
-    newForm.read()
-    newForm.removeShit()
-    newForm.writePretty(formPrettyDataPath)
+    def __init__(self, path, maxBytes=512 * 1024 * 1024):
+        self.path = path
+        self.maxBytes = maxBytes
+        self._saved = 0
 
-    for file in ['FileHeader',
-                 'Form.bin',
-                 'form.header',
-                 'module.header',
-                 'form.data']:
-        filePath = os.path.normpath(formDirName + '/' + file)
-        if os.path.exists(filePath):
-            os.remove(filePath)
+    def _entryPath(self, formPath):
 
+        key = os.path.normcase(os.path.abspath(formPath))
+        name = hashlib.sha1(key.encode('utf-8')).hexdigest() + '.marshal'
+        return os.path.join(self.path, name)
 
-def packForms(formPath, v8unpackpath):
+    def load(self, formPath):
 
-    formDirName = os.path.dirname(formPath)
+        entryPath = self._entryPath(formPath)
 
-    formDataPath = os.path.normpath(formDirName + '/form.data')
-    formPrettyDataPath = os.path.normpath(formDirName + '/form.prettydata')
+        try:
+            with open(entryPath, 'rb') as file:
+                version, size, mtime, digest, table = marshal.load(file)
+            stat = os.stat(formPath)
+        except (OSError, EOFError, ValueError, TypeError):
+            runCount('cache.form.miss')
+            return None
+
+        if version != self.VERSION or size != stat.st_size:
+            runCount('cache.form.miss')
+            return None
+
+        if mtime != stat.st_mtime_ns:
+            # Файл трогали - сверим содержимое
+            with open(formPath, 'rb') as file:
+                buffer = file.read()
+            if hashlib.sha1(buffer).hexdigest() != digest:
+                runCount('cache.form.miss')
+                return None
+            self.save(formPath, stat, buffer, table)
+        else:
+            os.utime(entryPath)
 
-    # Генерация файлов для unpack из исходников
+        runCount('cache.form.hit')
+        return table
 
-    prettyForm = Form(formPrettyDataPath)
-    prettyForm.read()
-    prettyForm.write(formDataPath)
+    def save(self, formPath, stat, buffer, table):
 
-    # Генерация заголовков
+        self._dump(self._entryPath(formPath),
+                   (self.VERSION, stat.st_size, stat.st_mtime_ns,
+                    hashlib.sha1(buffer).hexdigest(), table))
 
-    fileHeaderPath = os.path.normpath(formDirName + '/FileHeader')
-    FileHeaderHex = binascii.unhexlify('FFFFFF7F000200000200000000000000')
+    def _contentPath(self, digest, kind):
 
-    FileHeader = open(fileHeaderPath, 'wb')
-    FileHeader.write(FileHeaderHex)
-    FileHeader.close()
+        return os.path.join(self.path, f'{digest}.{kind}.marshal')
+
+    def loadContent(self, digest, kind):
+        '''Данные вида kind ('tree' - таблица веток, 'braces' - парные
+           скобки ленивой формы), сохраненные для содержимого с хэшем
+           digest, None - нет
+        '''
+
+        entryPath = self._contentPath(digest, kind)
+
+        try:
+            with open(entryPath, 'rb') as file:
+                version, data = marshal.load(file)
+        except (OSError, EOFError, ValueError, TypeError):
+            runCount('cache.form.miss')
+            return None
+
+        if version != self.VERSION:
+            runCount('cache.form.miss')
+            return None
+
+        os.utime(entryPath)
+        runCount('cache.form.hit')
+        return data
+
+    def saveContent(self, digest, kind, data):
+
+        self._dump(self._contentPath(digest, kind), (self.VERSION, data))
+
+    def _dump(self, entryPath, entry):
+
+        # Временный файл у каждого потока и процесса свой
+
+        os.makedirs(self.path, exist_ok=True)
+
+        handle, tempPath = tempfile.mkstemp(suffix='.tmp', dir=self.path)
+        try:
+            with os.fdopen(handle, 'wb') as file:
+                marshal.dump(entry, file)
+            os.replace(tempPath, entryPath)
+        except BaseException:
+            if os.path.exists(tempPath):
+                os.remove(tempPath)
+            raise
+
+        self._saved = self._saved + 1
+        if self._saved % 50 == 1:
+            self.evict()
+
+    def evict(self):
+
+        # Удаляем давно не использованные записи, пока не уложимся в лимит
+
+        entries = []
+        total = 0
+        for entry in os.scandir(self.path):
+            if entry.name.endswith('.marshal'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total = total + stat.st_size
+
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.maxBytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total = total - size
+
+
+_formCache = {}
+_formCacheLock = threading.Lock()
+
+
+def formCache():
+
+    path = cacheDir()
+    if path is None:
+        return None
+
+    path = os.path.join(path, 'forms')
+    with _formCacheLock:
+        if path not in _formCache:
+            maxBytes = int(os.environ.get(CACHE_SIZE_ENV,
+                                          512 * 1024 * 1024))
+            _formCache[path] = FormCache(path, maxBytes)
+
+        return _formCache[path]
+
+
+##########################################
+#
+# Временные каталоги
+#
+#########################################
+
+# Информационные базы, логи конфигуратора и копии исходников пишутся
+# во временные каталоги. По умолчанию выбирается tmpfs (память), если
+# она есть, и каталог не больше лимита, иначе обычный временный каталог
+
+SCRATCH_DIR_ENV = 'UNPACKPY_SCRATCH_DIR'
+SCRATCH_SIZE_ENV = 'UNPACKPY_SCRATCH_SIZE'
+SCRATCH_CLEANUP_ENV = 'UNPACKPY_SCRATCH_CLEANUP'
+SCRATCH_KEEP_ENV = 'UNPACKPY_SCRATCH_KEEP'
+
+SCRATCH_CLEANUP = ['always', 'success']
+
+# Ожидаемый объем файловой информационной базы и во сколько раз
+# выгрузка обработки больше самой обработки
+
+SCRATCH_INFOBASE_SIZE = 32 * 1024 * 1024
+EPF_DUMP_RATIO = 10
+
+
+def fileSystemType(path):
+
+    # Тип файловой системы по /proc/mounts (Linux), None - не определить
+
+    try:
+        with open('/proc/mounts', 'r') as file:
+            mounts = [line.split()[1:3] for line in file]
+    except OSError:
+        return None
+
+    path = os.path.realpath(path)
+    result = None
+    longest = -1
+
+    for mountPoint, fsType in mounts:
+        mountPoint = mountPoint.replace('\\040', ' ')
+        prefix = mountPoint.rstrip('/') + '/'
+        if ((path == mountPoint or path.startswith(prefix)) and
+                len(mountPoint) > longest):
+            result = fsType
+            longest = len(mountPoint)
+
+    return result
+
+
+def isTmpfs(path):
+
+    return fileSystemType(path) in ('tmpfs', 'ramfs')
+
+
+def defaultScratchLocation():
+
+    path = tempfile.gettempdir()
+    if isTmpfs(path):
+        return path
+
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK) and \
+            isTmpfs('/dev/shm'):
+        return '/dev/shm'
+
+    return path
+
+
+def treeSize(path):
+
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                size = size + os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return size
+
+
+class ScratchStorage:
+
+    # location - каталог для временных данных, maxBytes - сколько можно
+    # занять в нем одновременно (0 - без лимита), остальное уходит в
+    # обычный временный каталог. cleanup - 'always' удалять всегда,
+    # 'success' - оставлять каталоги упавших операций для разбора.
+    # keep - не удалять между запусками каталоги с ключом (key в
+    # directory), старые удаляются при превышении лимита
+
+    def __init__(self, location=None, maxBytes=0, cleanup='always',
+                 keep=False):
+
+        if cleanup not in SCRATCH_CLEANUP:
+            raise Exception(f'Неизвестный режим очистки: {cleanup}')
+
+        self.location = location or defaultScratchLocation()
+        self.fallback = tempfile.gettempdir()
+        self.maxBytes = maxBytes
+        self.cleanup = cleanup
+        self.keep = keep
+        self.written = 0
+        self.directories = 0
+        self._reserved = 0
+        self._pruned = False
+        self._lock = threading.Lock()
+
+    @property
+    def inMemory(self):
+
+        return isTmpfs(self.location)
+
+    def _root(self, location):
+
+        return os.path.join(location, 'unpackpy-scratch')
+
+    def _prune(self):
+
+        # Сохраненные с прошлых запусков каталоги не должны
+        # занимать больше лимита, старые удаляются первыми
+
+        root = self._root(self.location)
+        if not self.maxBytes or not os.path.isdir(root):
+            return
+
+        # Занятые сейчас каталоги не трогаем
+
+        entries = []
+        for name in os.listdir(root):
+            path = os.path.join(root, name)
+            if name.endswith('.lock') or os.path.exists(path + '.lock'):
+                continue
+            entries.append((os.path.getmtime(path), treeSize(path), path))
+
+        total = sum(size for mtime, size, path in entries)
+        for mtime, size, path in sorted(entries):
+            if total <= self.maxBytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total = total - size
+
+    def _reserve(self, estimate):
+
+        # Каталог в выбранном месте, если хватает лимита и места
+
+        with self._lock:
+            if not self._pruned:
+                self._pruned = True
+                if self.keep:
+                    self._prune()
+
+            if self.maxBytes and self._reserved + estimate > self.maxBytes:
+                return self.fallback, 0
+
+            try:
+                free = shutil.disk_usage(self.location).free
+            except OSError:
+                return self.fallback, 0
+            if estimate > free:
+                return self.fallback, 0
+
+            self._reserved = self._reserved + estimate
+            return self.location, estimate
+
+    def _claim(self, root, prefix, key):
+
+        # Сохраняемый каталог ключа. Если его занял другой поток или
+        # процесс, берется следующий номер
+
+        name = prefix + hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+        slot = 0
+        while True:
+            path = os.path.join(root, f'{name}-{slot}')
+            try:
+                os.close(os.open(path + '.lock',
+                                 os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            except FileExistsError:
+                slot = slot + 1
+                continue
+
+            os.makedirs(path, exist_ok=True)
+            os.utime(path)
+            return path
+
+    def usage(self):
+
+        with self._lock:
+            return self.written, self.directories
+
+    def addUsage(self, written, directories):
+
+        # Объем, записанный в процессе пула
+
+        with self._lock:
+            self.written = self.written + written
+            self.directories = self.directories + directories
+
+    @contextlib.contextmanager
+    def directory(self, prefix='', estimate=0, key=None):
+        '''Временный каталог, estimate - ожидаемый объем данных, байт.
+           С keep каталог с ключом key не удаляется и при следующем
+           вызове с тем же ключом отдается вместе с содержимым
+        '''
+
+        location, reserved = self._reserve(estimate)
+
+        root = self._root(location)
+        os.makedirs(root, exist_ok=True)
+        kept = self.keep and key is not None
+        if kept:
+            path = self._claim(root, prefix, key)
+            before = treeSize(path)
+        else:
+            path = tempfile.mkdtemp(prefix=prefix, dir=root)
+            before = 0
+
+        success = False
+        try:
+            yield path
+            success = True
+        finally:
+            size = max(treeSize(path) - before, 0)
+            with self._lock:
+                self.written = self.written + size
+                self.directories = self.directories + 1
+                self._reserved = self._reserved - reserved
+
+            if kept:
+                os.remove(path + '.lock')
+            elif self.cleanup == 'success' and not success:
+                print(f'..Временный каталог сохранен: {path}')
+            else:
+                shutil.rmtree(path, ignore_errors=True)
+
+    def report(self):
+
+        if not self.directories:
+            return
+
+        kind = 'tmpfs' if self.inMemory else 'диск'
+        print(f'..Записано во временные каталоги: '
+              f'{self.written / 1024 / 1024:.1f} МБ'
+              f' ({self.location}, {kind}).')
+
+
+_scratch = {}
+_scratchLock = threading.Lock()
+
+
+def scratch():
+
+    location = os.environ.get(SCRATCH_DIR_ENV) or None
+    key = (location,
+           os.environ.get(SCRATCH_SIZE_ENV),
+           os.environ.get(SCRATCH_CLEANUP_ENV),
+           os.environ.get(SCRATCH_KEEP_ENV))
+
+    # Первое обращение может прийти из нескольких потоков сразу
+    with _scratchLock:
+        if key not in _scratch:
+            _scratch[key] = ScratchStorage(
+                location=location,
+                maxBytes=int(os.environ.get(SCRATCH_SIZE_ENV) or 0),
+                cleanup=os.environ.get(SCRATCH_CLEANUP_ENV) or 'always',
+                keep=os.environ.get(SCRATCH_KEEP_ENV) == '1')
+
+        return _scratch[key]
+
+
+##########################################
+#
+# Потоковое преобразование формы
+#
+#########################################
+
+# Структурные символы формата: "{", "}" и значения между ними,
+# запятые и переводы строк только разделяют значения
+
+_formTokenPattern = re.compile(r'[{}]|[^{},\r\n]+')
+_formBracePattern = re.compile(r'[{}]')
+_formBytesTokenPattern = re.compile(rb'[{}]|[^{},\r\n]+')
+
+
+def formTextIsPretty(text):
+    '''Признак формата form.prettydata: после строк из одной "{"
+       значения и закрывающие скобки идут с отступом табуляцией.
+       В form.data за ними следует строка, начинающаяся с "{"
+    '''
+
+    pos = 0
+    while pos < len(text):
+        end = text.find('\n', pos)
+        if end == -1:
+            end = len(text)
+        line = text[pos:end].strip('\r\ufeff')
+        pos = end + 1
+
+        if line == '{':
+            continue
+        return line[0:1] == '\t' or line in ('}', '},')
+
+    return False
+
+
+def _sourceClosed(text, start):
+
+    # Состояние FormCompactWriter перед веткой в исходном тексте:
+    # True, если перед ней последней записана "}"
+
+    pos = start - 1
+    while pos >= 0 and text[pos] in '\r\n\t{,':
+        pos = pos - 1
+
+    return pos >= 0 and text[pos] == '}'
+
+
+def _sourceIndent(text, start):
+
+    # Отступ строки, с которой начинается ветка в исходном тексте
+
+    lineStart = max(text.rfind('\n', 0, start), text.rfind('\r', 0, start))
+    return text[lineStart + 1:start]
+
+
+# Событие формы: kind - 'start_branch', 'value', 'base64_chunk' или
+# 'end_branch', value - строка (для значений), depth - глубина ветки
+# (корень - 0), offset - смещение лексемы в файле, байт
+
+FormEvent = collections.namedtuple('FormEvent', 'kind value depth offset')
+
+FORM_EVENTS_CHUNK = 1024 * 1024
+
+
+def formEvents(file, chunkSize=FORM_EVENTS_CHUNK):
+    '''События формы по мере чтения двоичного файла порциями, без
+       построения дерева. Строки ветки, первая строка которой начинается
+       с "#base64:", выдаются как base64_chunk. Табуляции отбрасываются
+       так же, как при чтении Form
+    '''
+
+    # Для открытых веток: None - строк еще не было, True - ветка base64
+
+    branches = []
+    pending = b''
+    position = 0
+
+    while True:
+        chunk = file.read(chunkSize)
+        buffer = pending + chunk
+
+        start = 0
+        if position == 0 and buffer[0:3] == codecs.BOM_UTF8:
+            start = 3
+
+        # Последнее значение порции может продолжиться в следующей
+
+        end = len(buffer)
+        if chunk:
+            end = max(buffer.rfind(b'{'), buffer.rfind(b'}'),
+                      buffer.rfind(b','), buffer.rfind(b'\n'),
+                      buffer.rfind(b'\r')) + 1
+
+        for match in _formBytesTokenPattern.finditer(buffer, start, end):
+            token = match.group()
+            offset = position + match.start()
+
+            if token == b'{':
+                if branches and branches[-1] is None:
+                    branches[-1] = False
+                yield FormEvent('start_branch', None, len(branches), offset)
+                branches.append(None)
+
+            elif token == b'}':
+                branches.pop()
+                yield FormEvent('end_branch', None, len(branches), offset)
+                if not branches:
+                    return
+
+            elif branches:
+                value = token.replace(b'\t', b'')
+                if not value:
+                    continue
+                value = value.decode('utf-8')
+
+                if branches[-1] is None:
+                    branches[-1] = value[0:8] == '#base64:'
+                kind = 'base64_chunk' if branches[-1] else 'value'
+
+                yield FormEvent(kind, value, len(branches) - 1, offset)
+
+        if not chunk:
+            return
+
+        pending = buffer[end:]
+        position = position + end
+
+
+class FormCompactWriter:
+
+    # Запись формы в формате form.data, повторяет Form._writeBranch
+
+    kind = 'compact'
+
+    def __init__(self, file):
+        self._file = file
+        self._branches = []
+        self._closed = False
+
+    def _beforeRow(self):
+
+        branch = self._branches[-1]
+        if branch['count'] != 0 and not branch['base64']:
+            self._file.write(',')
+        if branch['base64Break']:
+            branch['base64Break'] = False
+            self._file.write('\r\r\n')
+
+    def open(self):
+
+        if self._branches:
+            self._beforeRow()
+            self._file.write('\r\n{')
+        else:
+            self._file.write('{')
+
+        self._branches.append({'count': 0,
+                               'base64': False,
+                               'base64Break': False})
+
+    def copyBranch(self, text, start, end, kind):
+
+        # Ветка text[start:end + 1] из form.data выводится байт в байт,
+        # если состояние перед ней совпадает с исходным
+
+        if kind != 'compact' or not self._branches:
+            return False
+        if _sourceClosed(text, start) != self._closed:
+            return False
+
+        self._beforeRow()
+        self._file.write('\r\n')
+        self._file.write(text[start:end + 1])
+        self._closed = True
+
+        self._branches[-1]['count'] = self._branches[-1]['count'] + 1
+        return True
+
+    def value(self, value):
+
+        branch = self._branches[-1]
+        if branch['count'] == 0:
+            branch['base64'] = value[0:8] == '#base64:'
+
+        self._beforeRow()
+        self._file.write(value)
+        self._closed = False
+
+        branch['count'] = branch['count'] + 1
+        branch['base64Break'] = branch['base64']
+
+    def close(self):
+
+        if self._closed:
+            self._file.write('\r\n')
+
+        self._file.write('}')
+        self._closed = True
+
+        self._branches.pop()
+        if self._branches:
+            self._branches[-1]['count'] = self._branches[-1]['count'] + 1
+
+
+class FormPrettyWriter:
+
+    # Запись формы в формате form.prettydata, повторяет Form._writeBranchPretty
+
+    kind = 'pretty'
+
+    def __init__(self, file):
+        self._file = file
+        self._branches = []
+
+    def _beforeRow(self):
+
+        branch = self._branches[-1]
+        if branch['comma']:
+            branch['comma'] = False
+            self._file.write(',')
+
+    def open(self):
+
+        if self._branches:
+            self._beforeRow()
+
+        otst = '\t' * max(len(self._branches) - 1, 0)
+
+        if self._branches:
+            self._file.write('\r\n' + otst + '{')
+        else:
+            self._file.write(otst + '{')
+
+        self._branches.append({'count': 0,
+                               'base64': False,
+                               'comma': False,
+                               'otst': otst})
+
+    def copyBranch(self, text, start, end, kind):
+
+        # Ветка text[start:end + 1] из form.prettydata выводится байт в байт,
+        # если она остается на той же глубине
+
+        if kind != 'pretty' or not self._branches:
+            return False
+
+        otst = '\t' * max(len(self._branches) - 1, 0)
+        if _sourceIndent(text, start) != otst:
+            return False
+
+        self._beforeRow()
+        self._file.write('\r\n' + otst)
+        self._file.write(text[start:end + 1])
+
+        self._branches[-1]['count'] = self._branches[-1]['count'] + 1
+        self._branches[-1]['comma'] = True
+        return True
+
+    def value(self, value):
+
+        branch = self._branches[-1]
+        if branch['count'] == 0:
+            branch['base64'] = value[0:8] == '#base64:'
+
+        self._beforeRow()
+
+        if branch['base64']:
+            if branch['count'] == 0:
+                self._file.write('\r\n' + branch['otst'] + '\t')
+            self._file.write(value)
+        else:
+            self._file.write('\r\n' + branch['otst'] + '\t')
+            self._file.write(value)
+            branch['comma'] = True
+
+        branch['count'] = branch['count'] + 1
+
+    def close(self):
+
+        branch = self._branches.pop()
+        self._file.write('\r\n' + branch['otst'] + '}')
+
+        if self._branches:
+            self._branches[-1]['count'] = self._branches[-1]['count'] + 1
+            self._branches[-1]['comma'] = True
+
+
+class FormEventWriter:
+
+    # Запись событий formEvents в формате writerClass
+    # (FormCompactWriter или FormPrettyWriter)
+
+    def __init__(self, file, writerClass=FormCompactWriter):
+        self._writer = writerClass(file)
+
+    def event(self, event):
+
+        kind = event[0]
+        if kind == 'start_branch':
+            self._writer.open()
+        elif kind == 'end_branch':
+            self._writer.close()
+        else:
+            self._writer.value(event[1])
+
+    def write(self, events):
+
+        for event in events:
+            self.event(event)
+
+
+def convertFormData(srcPath, dstPath, writerClass):
+    '''Перекладывает форму из одного формата в другой за один проход,
+       без построения дерева
+    '''
+
+    with open(srcPath, 'rb') as src, \
+            open(dstPath, 'w', encoding='utf-8-sig', newline='') as dst:
+
+        FormEventWriter(dst, writerClass).write(formEvents(src))
+
+
+def prettyToCompact(prettyPath, dataPath):
+
+    convertFormData(prettyPath, dataPath, FormCompactWriter)
+
+
+def compactToPretty(dataPath, prettyPath):
+
+    convertFormData(dataPath, prettyPath, FormPrettyWriter)
+
+
+PATCH_BLOCK = 4096
+
+
+def _samePath(first, second):
+
+    return (os.path.normcase(os.path.abspath(first)) ==
+            os.path.normcase(os.path.abspath(second)))
+
+
+def patchFile(path, oldData, newData):
+    '''Перезапись файла с содержимым oldData на newData (bytes): при
+       той же длине пишутся только отличающиеся блоки, иначе - все от
+       первого отличающегося блока. Возвращает число записанных байт
+    '''
+
+    if newData == oldData:
+        return 0
+
+    writes = []
+    tail = None
+    for pos in range(0, len(newData), PATCH_BLOCK):
+        if newData[pos:pos + PATCH_BLOCK] != oldData[pos:pos + PATCH_BLOCK]:
+            if len(newData) != len(oldData):
+                tail = pos
+                break
+            writes.append(pos)
+
+    if tail is None and len(oldData) > len(newData):
+        tail = len(newData)
+
+    written = 0
+    with open(path, 'r+b') as file:
+        for pos in writes:
+            data = newData[pos:pos + PATCH_BLOCK]
+            file.seek(pos)
+            file.write(data)
+            written = written + len(data)
+
+        if tail is not None:
+            file.seek(tail)
+            file.write(newData[tail:])
+            file.truncate()
+            written = written + len(newData) - tail
+
+    return written
+
+
+def patchTextFile(path, oldText, newText):
+    '''Перезапись файла в utf-8 с текстом oldText на newText: на месте
+       пишутся только отличающиеся блоки, а после первого блока другой
+       длины в байтах - весь остаток файла. Возвращает число записанных
+       байт
+    '''
+
+    if newText == oldText:
+        return 0
+
+    with open(path, 'r+b') as file:
+        pos = 3 if file.read(3) == codecs.BOM_UTF8 else 0
+
+        writes = []
+        tail = None
+        for i in range(0, len(newText), PATCH_BLOCK):
+            new = newText[i:i + PATCH_BLOCK]
+            old = oldText[i:i + PATCH_BLOCK]
+            data = new.encode('utf-8')
+            if new != old:
+                if len(data) != len(old.encode('utf-8')):
+                    tail = i
+                    break
+                writes.append((pos, data))
+            pos = pos + len(data)
+
+        if tail is None and len(oldText) > len(newText):
+            tail = len(newText)
+
+        for offset, data in writes:
+            file.seek(offset)
+            file.write(data)
+        written = sum(len(data) for offset, data in writes)
+
+        if tail is not None:
+            data = newText[tail:].encode('utf-8')
+            file.seek(pos)
+            file.write(data)
+            file.truncate()
+            written = written + len(data)
+
+    return written
+
+##########################################
+#
+# Проверка корпуса форм
+#
+#########################################
+
+
+def formBytes(form, writerClass):
+
+    # Форма в том виде, в каком ее записал бы Form._write
+
+    text = io.StringIO(newline='')
+    form._emitBranch(form._formDataTree, writerClass(text))
+    return codecs.BOM_UTF8 + text.getvalue().encode('utf-8')
+
+
+def firstDifference(expected, actual):
+
+    # Описание первого расхождения: позиция, строка и фрагменты
+
+    size = min(len(expected), len(actual))
+    pos = next((i for i in range(size) if expected[i] != actual[i]), size)
+    line = expected.count(b'\n', 0, pos) + 1
+
+    return (f'байт {pos}, строка {line}: '
+            f'ожидалось {expected[pos:pos + 20]!r}, '
+            f'получено {actual[pos:pos + 20]!r}')
+
+
+def _firstValue(form):
+
+    # Путь к первому значению в дочерних ветках корня: ветка и номер
+
+    for branch in form._formDataTree['rows']:
+        if not isinstance(branch, dict):
+            continue
+        for i, row in enumerate(branch['rows']):
+            if not isinstance(row, dict):
+                return branch, i
+
+    return None, None
+
+
+def verifyLazyForm(path, form, same, other):
+
+    # Ленивое чтение: корень разобран, дочерние ветки копируются
+    # из исходного текста (copyBranch) или перекладываются по лексемам
+
+    lazy = Form(path, lazy=True, cache=False)
+    lazy.read()
+    lazy._formDataTree['rows']
+
+    return [('ленивое чтение', formBytes(form, same), formBytes(lazy, same)),
+            ('ленивое чтение, другой формат', formBytes(form, other),
+             formBytes(lazy, other))]
+
+
+def verifyFormEvents(buffer, form, same, other):
+
+    # Потоковое преобразование formEvents, порции меньше формы,
+    # чтобы проверить и стыки порций
+
+    checks = []
+    for name, writerClass in (('поток', same), ('поток, другой формат', other)):
+        text = io.StringIO(newline='')
+        FormEventWriter(text, writerClass).write(
+            formEvents(io.BytesIO(buffer), chunkSize=4096))
+        checks.append((name, formBytes(form, writerClass),
+                       codecs.BOM_UTF8 + text.getvalue().encode('utf-8')))
+
+    return checks
+
+
+def verifyIncrementalWrite(buffer, form, same):
+
+    # Запись поверх прочитанного файла: без изменений и после изменения
+    # одного значения. Эталон - та же правка в полностью разобранной форме
+
+    checks = []
+
+    with scratch().directory('verify-') as tempdir:
+        tempPath = os.path.join(tempdir, 'form')
+        with open(tempPath, 'wb') as file:
+            file.write(buffer)
+
+        lazy = Form(tempPath, lazy=True, cache=False)
+        lazy.read()
+        lazy._write(tempPath, same)
+        with open(tempPath, 'rb') as file:
+            checks.append(('запись поверх файла', formBytes(form, same),
+                           file.read()))
+
+        branch, index = _firstValue(lazy)
+        if branch is not None:
+            branch['rows'][index] = branch['rows'][index] + '0'
+            lazy._write(tempPath, same)
+
+            branch, index = _firstValue(form)
+            branch['rows'][index] = branch['rows'][index] + '0'
+
+            with open(tempPath, 'rb') as file:
+                checks.append(('запись поверх файла после правки',
+                               formBytes(form, same), file.read()))
+
+    return checks
+
+
+def verifyFormFile(path):
+    '''Проверка побайтного совпадения для файла формы:
+       чтение -> запись в том же формате и обход через другой формат.
+       form.prettydata: чтение -> запись form.data -> чтение -> запись
+       должно дать исходный файл. В prettydata строки base64 склеиваются,
+       поэтому для form.data обход проверяется по prettydata:
+       чтение -> запись prettydata -> чтение -> запись prettydata
+       должно совпасть с первой записью prettydata.
+       Ленивое чтение, потоковое преобразование и запись поверх файла
+       должны давать то же, что полный разбор
+    '''
+
+    begin = time.perf_counter()
+    result = {'path': path, 'size': 0, 'error': None}
+
+    try:
+        with open(path, 'rb') as file:
+            buffer = file.read()
+        result['size'] = len(buffer)
+
+        form = Form(path)
+        form.readBuffer(buffer)
+
+        if formTextIsPretty(buffer[:4096].decode('utf-8', 'replace')):
+            same, other = FormPrettyWriter, FormCompactWriter
+            expected = buffer
+        else:
+            same, other = FormCompactWriter, FormPrettyWriter
+            expected = formBytes(form, other)
+
+        checks = [('запись', buffer, formBytes(form, same))]
+
+        converted = Form(path)
+        converted.readBuffer(formBytes(form, other))
+        checks.append(('через другой формат', expected,
+                       formBytes(converted, FormPrettyWriter)))
+
+        checks.extend(verifyLazyForm(path, form, same, other))
+        checks.extend(verifyFormEvents(buffer, form, same, other))
+
+        # Правит форму, поэтому последняя
+
+        checks.extend(verifyIncrementalWrite(buffer, form, same))
+
+        for name, expected, actual in checks:
+            if actual != expected:
+                result['error'] = (f'{name}: '
+                                   f'{firstDifference(expected, actual)}')
+                break
+
+    except Exception as error:
+        result['error'] = f'{type(error).__name__}: {error}'
+
+    result['seconds'] = time.perf_counter() - begin
+    return result
+
+
+def _verifyFormFileTask(path):
+
+    return profiledCall(verifyFormFile, path)
+
+
+def verifyCorpus(path, jobs=None, maxFailures=10, report=None, slowest=5):
+    '''Проверка всех form.data и form.prettydata в каталоге на пуле
+       процессов. Результаты выводятся по мере готовности, после
+       maxFailures ошибок (0 - без ограничения) проверка прекращается.
+       Возвращает число ошибок
+    '''
+
+    files = findFiles(path, 'form.data') + findFiles(path, 'form.prettydata')
+    print(f'..Проверяем форм: {len(files)}.')
+
+    begin = time.perf_counter()
+    results = []
+    failures = 0
+
+    reportFile = None
+    if report is not None:
+        reportFile = open(report, 'w', encoding='utf-8')
+
+    try:
+        with Pool(jobs) as pool:
+            for result in pool.imap_unordered(_verifyFormFileTask, files,
+                                              chunksize=4):
+                results.append(result)
+
+                if reportFile is not None:
+                    reportFile.write(json.dumps(result, ensure_ascii=False)
+                                     + '\n')
+
+                if result['error'] is not None:
+                    failures = failures + 1
+                    print(f'..Ошибка {result["path"]}: {result["error"]}')
+
+                    if maxFailures and failures >= maxFailures:
+                        print('..Достигнут предел ошибок, проверка прервана.')
+                        break
+
+                print(f'..Проверено {len(results)} из {len(files)}.',
+                      end='\r')
+    finally:
+        if reportFile is not None:
+            reportFile.close()
+
+    seconds = time.perf_counter() - begin
+    size = sum(result['size'] for result in results)
+    runCount('forms', len(results))
+    runCount('bytes', size)
+    size = size / 1024 / 1024
+
+    print(f'..Проверено форм: {len(results)}, ошибок: {failures},'
+          f' {size:.1f} МБ за {seconds:.1f} с'
+          f' ({size / max(seconds, 1e-9):.1f} МБ/с).')
+
+    for result in sorted(results, key=lambda x: -x['seconds'])[:slowest]:
+        print(f'..{result["seconds"]:.3f} с'
+              f' {result["size"] / 1024:.0f} КБ {result["path"]}')
+
+    return failures
+
+
+##########################################
+#
+# Слияние обычных форм
+#
+#########################################
+
+_guidPattern = re.compile(
+    r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$')
+
+
+def readFormFile(path):
+
+    # Ленивая форма любого из форматов и признак "красивого" формата
+
+    form = Form(path, lazy=True)
+    form.read()
+
+    return form, form._lazyKind == 'pretty'
+
+
+def formRowKey(row, keys):
+    '''Ключ строки для сравнения: значение как есть,
+       для ветки - хэш поддерева (keys кэширует хэши по id ветки)
+    '''
+
+    if not isinstance(row, dict):
+        return row
+
+    key = keys.get(id(row))
+    if key is not None:
+        return key
+
+    if isinstance(row, _LazyBranch):
+        # Поддерево ленивой формы сравнивается по тексту без отступов
+        start, end = row.span
+        text = row._form._lazyText[start:end + 1]
+        text = text.replace('\t', '').replace('\r', '').replace('\n', '')
+        key = hashlib.sha1(text.encode('utf-8')).digest()
+        keys[id(row)] = key
+
+    else:
+        digest = hashlib.sha1()
+        for child in row['rows']:
+            childKey = formRowKey(child, keys)
+            if isinstance(childKey, bytes):
+                digest.update(b'b' + childKey)
+            else:
+                value = childKey.encode('utf-8')
+                digest.update(b's' + len(value).to_bytes(4, 'little') + value)
+        key = digest.digest()
+        keys[id(row)] = key
+
+    return key
+
+
+def formPathContext(path, branches):
+
+    # Описание места в форме: индексы от корня, GUID и имя ближайших веток
+
+    guid = None
+    name = None
+    for branch in reversed(branches):
+        rows = branch['rows']
+        if guid is None and rows and not isinstance(rows[0], dict) and \
+                _guidPattern.match(rows[0]):
+            guid = rows[0]
+        if name is None:
+            name = next((x for x in rows if not isinstance(x, dict) and
+                         x[0:1] == '"' and len(x) > 2), None)
+
+    result = '/' + '/'.join(str(x) for x in path)
+    if guid is not None:
+        result = result + f' [{guid}]'
+    if name is not None:
+        result = result + f' {name}'
+
+    return result
+
+
+class FormMerge:
+
+    # Трехстороннее слияние деревьев формы, одинаковые поддеревья
+    # распознаются по хэшу и не обходятся
+
+    def __init__(self):
+        self.conflicts = []
+        self._keys = {}
+
+    def _key(self, row):
+
+        return formRowKey(row, self._keys)
+
+    def _conflict(self, path, branches):
+
+        self.conflicts.append(formPathContext(path, branches))
+
+    def mergeRow(self, base, ours, theirs, path, branches):
+
+        if self._key(ours) == self._key(theirs):
+            return ours
+        if base is not None:
+            if self._key(base) == self._key(ours):
+                return theirs
+            if self._key(base) == self._key(theirs):
+                return ours
+
+        if (isinstance(base, dict) and isinstance(ours, dict) and
+                isinstance(theirs, dict)):
+            return self.mergeBranch(base, ours, theirs, path, branches)
+
+        self._conflict(path, branches)
+        return ours
+
+    def mergeBranch(self, base, ours, theirs, path, branches):
+
+        branches = branches + [ours]
+        baseRows = base['rows']
+        oursRows = ours['rows']
+        theirsRows = theirs['rows']
+
+        if len(baseRows) == len(oursRows) == len(theirsRows):
+            rows = [self.mergeRow(baseRows[i], oursRows[i], theirsRows[i],
+                                  path + [i], branches)
+                    for i in range(len(baseRows))]
+
+        elif len(oursRows) == len(baseRows) or len(theirsRows) == len(baseRows):
+            rows = self._mergeSequence(baseRows, oursRows, theirsRows,
+                                       path, branches)
+
+        else:
+            # Количество строк изменили обе стороны: в форме за списками
+            # следуют их счетчики, склеивать вставки небезопасно
+            self._conflict(path, branches)
+            rows = oursRows
+
+        return {'rows': rows, 'parent': None}
+
+    def _shape(self, row):
+
+        # Грубый ключ: ветки одного вида (первое значение) считаются
+        # одной и той же измененной веткой
+
+        if not isinstance(row, dict):
+            return row
+
+        rows = row['rows']
+        if rows and not isinstance(rows[0], dict):
+            return ('branch', rows[0])
+
+        return ('branch', None)
+
+    def _matches(self, baseRows, otherRows):
+
+        # Сопоставление строк базы строкам стороны: совпавшие строки,
+        # замены одинаковой длины (строка изменена на месте), а в заменах
+        # разной длины - ветки одного вида
+
+        baseKeys = [self._key(x) for x in baseRows]
+        otherKeys = [self._key(x) for x in otherRows]
+
+        matcher = difflib.SequenceMatcher(None, baseKeys, otherKeys,
+                                          autojunk=False)
+        result = {}
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if tag == 'equal' or (tag == 'replace' and i2 - i1 == j2 - j1):
+                for i in range(i2 - i1):
+                    result[i1 + i] = j1 + i
+
+            elif tag == 'replace':
+                shapes = difflib.SequenceMatcher(
+                    None,
+                    [self._shape(x) for x in baseRows[i1:i2]],
+                    [self._shape(x) for x in otherRows[j1:j2]],
+                    autojunk=False)
+                for a, b, size in shapes.get_matching_blocks():
+                    for i in range(size):
+                        result[i1 + a + i] = j1 + b + i
+
+        return result
+
+    def _mergeSequence(self, baseRows, oursRows, theirsRows, path, branches):
+
+        # diff3: строки базы, сопоставленные обеим сторонам, служат опорами
+        # и сливаются по отдельности, вставки и удаления между опорами
+        # берутся с той стороны, где они сделаны
+
+        oursMatch = self._matches(baseRows, oursRows)
+        theirsMatch = self._matches(baseRows, theirsRows)
+
+        anchors = [(i, oursMatch[i], theirsMatch[i]) for i in sorted(oursMatch)
+                   if i in theirsMatch]
+        anchors.append((len(baseRows), len(oursRows), len(theirsRows)))
+
+        rows = []
+        prev = (-1, -1, -1)
+        for anchor in anchors:
+            baseChunk = baseRows[prev[0] + 1:anchor[0]]
+            oursChunk = oursRows[prev[1] + 1:anchor[1]]
+            theirsChunk = theirsRows[prev[2] + 1:anchor[2]]
+
+            baseChunkKeys = [self._key(x) for x in baseChunk]
+            oursChunkKeys = [self._key(x) for x in oursChunk]
+            theirsChunkKeys = [self._key(x) for x in theirsChunk]
+
+            if oursChunkKeys == theirsChunkKeys:
+                rows.extend(oursChunk)
+            elif baseChunkKeys == oursChunkKeys:
+                rows.extend(theirsChunk)
+            elif baseChunkKeys == theirsChunkKeys:
+                rows.extend(oursChunk)
+            else:
+                self._conflict(path + [len(rows)], branches)
+                rows.extend(oursChunk)
+
+            if anchor[0] < len(baseRows):
+                rows.append(self.mergeRow(baseRows[anchor[0]],
+                                          oursRows[anchor[1]],
+                                          theirsRows[anchor[2]],
+                                          path + [len(rows)], branches))
+            prev = anchor
+
+        return rows
+
+
+def mergeForms(base, ours, theirs, output=None):
+    '''Трехстороннее слияние файлов формы, результат пишется в output
+       (по умолчанию в ours) в формате ours. Возвращает список конфликтов,
+       в местах конфликтов остается вариант ours
+    '''
+
+    if output is None:
+        output = ours
+
+    # Одинаковые файлы целиком - разбирать нечего
+
+    oursHash = file_hash(ours)
+    theirsHash = file_hash(theirs)
+    if oursHash == theirsHash or file_hash(base) == theirsHash:
+        if os.path.abspath(output) != os.path.abspath(ours):
+            shutil.copyfile(ours, output)
+        return []
+
+    baseForm = readFormFile(base)[0]
+    oursForm, pretty = readFormFile(ours)
+    theirsForm = readFormFile(theirs)[0]
+
+    merge = FormMerge()
+    oursForm._formDataTree = merge.mergeRow(baseForm._formDataTree,
+                                            oursForm._formDataTree,
+                                            theirsForm._formDataTree,
+                                            [], [])
+
+    if pretty:
+        oursForm.writePretty(output)
+    else:
+        oursForm.write(output)
+
+    return merge.conflicts
+
+##########################################
+#
+# Сравнение обычных форм
+#
+#########################################
+
+FORM_DIFF_WIDTH = 120
+
+
+def formRowText(row, width=FORM_DIFF_WIDTH):
+
+    # Строка формы для вывода: значение как есть, ветка - начало
+    # ее строк в одну строку
+
+    if not isinstance(row, dict):
+        text = row
+    else:
+        parts = []
+        size = 0
+        for child in row['rows']:
+            part = '{...}' if isinstance(child, dict) else child
+            parts.append(part)
+            size = size + len(part) + 1
+            if size > width:
+                break
+        text = '{' + ','.join(parts) + '}'
+
+    if len(text) > width:
+        text = text[:width - 3] + '...'
+    return text
+
+
+class FormDiff:
+
+    # Структурное сравнение деревьев формы: одинаковые поддеревья
+    # распознаются по хэшу и не обходятся, строки сопоставляются
+    # так же, как при слиянии (FormMerge)
+
+    def __init__(self):
+        self.changes = []
+        self._merge = FormMerge()
+
+    def _key(self, row):
+
+        return self._merge._key(row)
+
+    def _change(self, path, branches, old, new):
+
+        self.changes.append((formPathContext(path, branches), old, new))
+
+    def diffRow(self, old, new, path, branches):
+
+        if self._key(old) == self._key(new):
+            return
+
+        if isinstance(old, dict) and isinstance(new, dict):
+            self.diffBranch(old, new, path, branches)
+        else:
+            self._change(path, branches, old, new)
+
+    def diffBranch(self, old, new, path, branches):
+
+        # Пути - по новой версии, у удаленных строк - номер
+        # в старой версии
+
+        branches = branches + [new]
+        oldRows = old['rows']
+        newRows = new['rows']
+        matches = self._merge._matches(oldRows, newRows)
+
+        j = 0
+        for i, row in enumerate(oldRows):
+            match = matches.get(i)
+            if match is None:
+                self._change(path + [i], branches, row, None)
+                continue
+
+            for j in range(j, match):
+                self._change(path + [j], branches, None, newRows[j])
+
+            self.diffRow(row, newRows[match], path + [match], branches)
+            j = match + 1
+
+        for j in range(j, len(newRows)):
+            self._change(path + [j], branches, None, newRows[j])
+
+
+def diffSideExists(path):
+
+    # Есть ли версия формы для сравнения: у добавленного или удаленного
+    # файла git передает /dev/null
+
+    if path is None or path in ('/dev/null', os.devnull):
+        return False
+
+    return os.path.exists(path) and os.path.getsize(path) != 0
+
+
+def diffForms(old, new):
+    '''Изменения между двумя файлами формы (любого формата):
+       список (место, старая строка, новая строка), у добавленной
+       строки старая - None, у удаленной новая - None
+    '''
+
+    oldExists = diffSideExists(old)
+    newExists = diffSideExists(new)
+
+    if not oldExists and not newExists:
+        return []
+    if oldExists and newExists and file_hash(old) == file_hash(new):
+        return []
+
+    if not oldExists:
+        return [(formPathContext([], []), None,
+                 readFormFile(new)[0]._formDataTree)]
+    if not newExists:
+        return [(formPathContext([], []),
+                 readFormFile(old)[0]._formDataTree, None)]
+
+    oldForm = readFormFile(old)[0]
+    newForm = readFormFile(new)[0]
+
+    # Файлы разные, корни можно не сравнивать по хэшу
+
+    diff = FormDiff()
+    diff.diffBranch(oldForm._formDataTree, newForm._formDataTree, [], [])
+
+    return diff.changes
+
+
+def printFormDiff(changes, oldName, newName, file=None):
+
+    if file is None:
+        file = sys.stdout
+    if not changes:
+        return
+
+    print(f'diff-form a/{oldName} b/{newName}', file=file)
+    for place, old, new in changes:
+        print(f'@@ {place}', file=file)
+        if old is not None:
+            print(f'- {formRowText(old)}', file=file)
+        if new is not None:
+            print(f'+ {formRowText(new)}', file=file)
+
+##########################################
+#
+# Контейнер 1С:Предприятие
+#
+#########################################
+
+# Формат контейнера (epf, Form.bin): заголовок 16 байт, затем документы
+# из блоков. Блок начинается строкой "\r\n<размер документа> <размер
+# блока> <адрес следующего блока> \r\n" (hex по 8 символов).
+# Первый документ - оглавление: адреса заголовка и данных элементов
+
+V8_SIGNATURE = b'\xff\xff\xff\x7f'
+V8_END = 0x7fffffff
+V8_BLOCK_HEADER_SIZE = 31
+
+_v8BlockHeaderPattern = re.compile(
+    rb'\r\n([0-9a-fA-F]{8}) ([0-9a-fA-F]{8}) ([0-9a-fA-F]{8}) \r\n')
+
+
+def isV8Container(data):
+
+    return (data[0:4] == V8_SIGNATURE and
+            len(data) >= 16 + V8_BLOCK_HEADER_SIZE)
+
+
+def readV8Document(buffer, offset):
+
+    chunks = []
+    remaining = None
+    seen = set()
+
+    while offset != V8_END:
+        if offset in seen:
+            raise ValueError('Зацикленная цепочка блоков контейнера')
+        seen.add(offset)
+
+        match = _v8BlockHeaderPattern.match(buffer, offset)
+        if match is None:
+            raise ValueError(f'Неверный блок контейнера по адресу {offset}')
+
+        docSize, pageSize, nextPage = [int(x, 16) for x in match.groups()]
+        if remaining is None:
+            remaining = docSize
+
+        start = offset + V8_BLOCK_HEADER_SIZE
+        chunk = buffer[start:start + min(pageSize, remaining)]
+        chunks.append(chunk)
+
+        remaining = remaining - len(chunk)
+        if remaining <= 0:
+            break
+        offset = nextPage
+
+    return b''.join(chunks)
+
+
+def readV8Container(buffer):
+    '''Элементы контейнера по порядку оглавления:
+       имя, заголовок и данные как есть (без распаковки)
+    '''
+
+    if not isV8Container(buffer):
+        raise ValueError('Данные не являются контейнером 1С')
+
+    toc = readV8Document(buffer, 16)
+
+    elements = []
+    for i in range(0, len(toc) - 11, 12):
+        headerAddr, dataAddr, reserved = struct.unpack_from('<III', toc, i)
+
+        header = readV8Document(buffer, headerAddr)
+        name = header[20:].decode('utf-16-le', 'replace').split('\x00')[0]
+
+        if dataAddr == V8_END:
+            data = b''
+        else:
+            data = readV8Document(buffer, dataAddr)
+
+        elements.append({'name': name, 'header': header, 'data': data})
+
+    return elements
+
+
+def inflateV8(data):
+
+    # Данные элементов сжаты deflate без заголовка, None - не сжаты
+
+    decompressor = zlib.decompressobj(-15)
+    try:
+        result = decompressor.decompress(data)
+    except zlib.error:
+        return None
+
+    if not decompressor.eof or decompressor.unused_data:
+        return None
+
+    return result
+
+
+def deflateV8(data):
+
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _v8Block(data, pageSize=None):
+
+    # Документ одним блоком, без цепочки
+
+    if pageSize is None:
+        pageSize = len(data)
+
+    header = b'\r\n%08x %08x %08x \r\n' % (len(data), pageSize, V8_END)
+    return header + data + b'\x00' * (pageSize - len(data))
+
+
+def writeV8Container(elements, header=None):
+    '''Контейнер из элементов в формате readV8Container:
+       оглавление, затем заголовки и данные элементов одним блоком
+    '''
+
+    if header is None:
+        header = V8_SIGNATURE + struct.pack('<III', 0x200, 0, 0)
+
+    pageSize = struct.unpack_from('<I', header, 4)[0] or 0x200
+    tocSize = 12 * len(elements)
+    tocPage = max(pageSize, tocSize)
+
+    offset = 16 + V8_BLOCK_HEADER_SIZE + tocPage
+    toc = bytearray()
+    blocks = []
+
+    for element in elements:
+        headerAddr = offset
+        blocks.append(_v8Block(element['header']))
+        offset += len(blocks[-1])
+
+        dataAddr = offset
+        blocks.append(_v8Block(element['data']))
+        offset += len(blocks[-1])
+
+        toc += struct.pack('<III', headerAddr, dataAddr, V8_END)
+
+    return b''.join([header[:16], _v8Block(bytes(toc), tocPage)] + blocks)
+
+
+def v8ElementData(buffer, path):
+
+    # Распакованные данные элемента по пути вида "имя/имя", None - нет такого
+
+    name, _, rest = path.partition('/')
+
+    for element in readV8Container(buffer):
+        if element['name'] != name:
+            continue
+
+        data = inflateV8(element['data'])
+        if data is None:
+            data = element['data']
+
+        if not rest:
+            return data
+        if not isV8Container(data):
+            return None
+        return v8ElementData(data, rest)
+
+    return None
+
+
+def patchV8Container(buffer, replacements):
+    '''Замена данных элементов по путям вида "имя/имя" (с учетом вложенных
+       контейнеров). Сжатые элементы сжимаются заново, остальные
+       элементы и заголовки копируются как есть
+    '''
+
+    elements = readV8Container(buffer)
+    found = set()
+
+    for element in elements:
+        name = element['name']
+        nested = {path[len(name) + 1:]: data
+                  for path, data in replacements.items()
+                  if path.startswith(name + '/')}
+
+        if name not in replacements and not nested:
+            continue
+
+        data = inflateV8(element['data'])
+        compressed = data is not None
+        if not compressed:
+            data = element['data']
+
+        if name in replacements:
+            data = replacements[name]
+            found.add(name)
+        else:
+            data = patchV8Container(data, nested)
+            found.update(name + '/' + path for path in nested)
+
+        element['data'] = deflateV8(data) if compressed else data
+
+    missing = set(replacements) - found
+    if missing:
+        raise ValueError(
+            f'В контейнере нет элементов: {", ".join(sorted(missing))}')
+
+    return writeV8Container(elements, buffer[:16])
+
+
+def v8ContainerHashes(buffer, prefix=''):
+    '''Хэши содержимого элементов контейнера с учетом вложенных контейнеров.
+       Заголовки элементов (даты создания и изменения) не учитываются
+    '''
+
+    result = {}
+
+    for element in readV8Container(buffer):
+        name = prefix + element['name']
+
+        data = inflateV8(element['data'])
+        if data is None:
+            data = element['data']
+
+        if isV8Container(data):
+            result.update(v8ContainerHashes(data, name + '/'))
+        else:
+            result[name] = hashlib.sha1(data).hexdigest()
+
+    return result
+
+
+def epfObjectHashes(epf, buffer=None):
+
+    # None - контейнер прочитать не удалось, сравнивать не с чем
+
+    if buffer is None:
+        with open(epf, 'rb') as file:
+            buffer = file.read()
+
+    try:
+        return v8ContainerHashes(buffer)
+    except (ValueError, struct.error):
+        return None
+
+
+EPF_MANIFEST_VERSION = 2
+
+
+def epfManifestPath(xml):
+
+    path = cacheDir()
+    if path is None:
+        return None
+
+    key = os.path.normcase(os.path.abspath(xml))
+    name = hashlib.sha1(key.encode('utf-8')).hexdigest() + '.json'
+    return os.path.join(path, 'epf', name)
+
+
+def _epfSourceKey(xml, path):
+
+    return os.path.relpath(path, os.path.dirname(xml)).replace('\\', '/')
+
+
+def epfSourcesState(xml):
+
+    # Исходники тоже могли поправить руками - запоминаем размер и время
+    # изменения xml обработки и всех файлов каталога ее исходников
+
+    files = [xml]
+    for dirpath, dirnames, filenames in os.walk(os.path.splitext(xml)[0]):
+        files.extend(os.path.join(dirpath, x) for x in filenames)
+
+    state = {}
+    for path in files:
+        stat = os.stat(path)
+        state[_epfSourceKey(xml, path)] = [stat.st_size, stat.st_mtime_ns]
+
+    return state
+
+
+def epfUnchanged(xml, hashes, changed=()):
+    '''Содержимое обработки совпадает с разобранным в прошлый раз,
+       а исходники с тех пор не трогали. changed - файлы исходников,
+       изменение которых не учитывается
+    '''
+
+    manifestPath = epfManifestPath(xml)
+    if hashes is None or manifestPath is None:
+        return False
+    if not os.path.exists(xml) or not os.path.exists(manifestPath):
+        return False
+
+    # Испорченный манифест - как будто его нет
+
+    try:
+        with open(manifestPath, 'r', encoding='utf-8') as file:
+            manifest = json.load(file)
+    except (OSError, ValueError):
+        return False
+
+    if not isinstance(manifest, dict):
+        return False
+
+    sources = manifest.get('sources')
+    current = epfSourcesState(xml)
+    if not isinstance(sources, dict):
+        return False
+
+    for path in changed:
+        key = _epfSourceKey(xml, path)
+        sources.pop(key, None)
+        current.pop(key, None)
+
+    return (manifest.get('version') == EPF_MANIFEST_VERSION and
+            sources == current and
+            manifest.get('objects') == hashes)
+
+
+def saveEpfManifest(xml, hashes):
+
+    manifestPath = epfManifestPath(xml)
+    if hashes is None or manifestPath is None:
+        return
+
+    os.makedirs(os.path.dirname(manifestPath), exist_ok=True)
+    with open(manifestPath, 'w', encoding='utf-8') as file:
+        json.dump({'version': EPF_MANIFEST_VERSION,
+                   'sources': epfSourcesState(xml),
+                   'objects': hashes}, file)
+
+##########################################
+#
+# Планировщик форм по памяти
+#
+#########################################
+
+# Бюджет памяти на одновременно обрабатываемые формы, байт.
+# Оценка формы - размер файла, умноженный на коэффициент вида задачи.
+# Коэффициенты уточняются замерами tracemalloc в процессах пула и
+# запоминаются в каталоге кэша
+
+MEMORY_BUDGET_ENV = 'UNPACKPY_MEMORY_BUDGET'
+
+MEMORY_RATIO_DEFAULT = 8.0
+MEMORY_SAMPLE_EVERY = 10
+
+# Задачи, которые запускают v8unpack.exe: его память tracemalloc не
+# видит, поэтому они не замеряются и оцениваются постоянным коэффициентом
+
+MEMORY_EXTERNAL_TASKS = ['unpackForms', 'packForms']
+MEMORY_RATIO_EXTERNAL = 8.0
+
+
+def physicalMemory():
+
+    # Объем памяти машины, None - не определить
+
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (AttributeError, ValueError, OSError):
+        pass
+
+    if sys.platform == 'win32':
+        import ctypes
+
+        class MEMORYSTATUSEX(ctypes.Structure):
+            _fields_ = [('dwLength', ctypes.c_ulong),
+                        ('dwMemoryLoad', ctypes.c_ulong),
+                        ('ullTotalPhys', ctypes.c_ulonglong),
+                        ('ullAvailPhys', ctypes.c_ulonglong),
+                        ('ullTotalPageFile', ctypes.c_ulonglong),
+                        ('ullAvailPageFile', ctypes.c_ulonglong),
+                        ('ullTotalVirtual', ctypes.c_ulonglong),
+                        ('ullAvailVirtual', ctypes.c_ulonglong),
+                        ('ullAvailExtendedVirtual', ctypes.c_ulonglong)]
+
+        status = MEMORYSTATUSEX()
+        status.dwLength = ctypes.sizeof(MEMORYSTATUSEX)
+        if ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status)):
+            return status.ullTotalPhys
+
+    return None
+
+
+def memoryBudget():
+
+    # По умолчанию формам отдаем половину памяти машины
+
+    budget = os.environ.get(MEMORY_BUDGET_ENV)
+    if budget:
+        return int(budget)
+
+    total = physicalMemory()
+    return total // 2 if total else None
+
+
+class MemoryHistory:
+
+    # Коэффициенты "пик памяти / размер файла" по видам задач
+
+    def __init__(self, path=None):
+        self.path = path
+        self.ratios = {}
+        self._lock = threading.Lock()
+
+        if path is not None and os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as file:
+                    self.ratios = json.load(file)
+            except (OSError, ValueError):
+                self.ratios = {}
+
+    def ratio(self, kind):
+
+        return self.ratios.get(kind, MEMORY_RATIO_DEFAULT)
+
+    def update(self, kind, samples):
+
+        # Рост учитываем сразу, снижение - постепенно
+
+        if not samples:
+            return
+
+        with self._lock:
+            old = self.ratios.get(kind)
+            new = max(samples)
+            if old is not None:
+                new = max(new, old * 0.9)
+            self.ratios[kind] = new
+
+    def save(self):
+
+        # Временный файл у каждого потока и процесса свой
+
+        if self.path is None:
+            return
+
+        directory = os.path.dirname(self.path)
+        os.makedirs(directory, exist_ok=True)
+
+        with self._lock:
+            handle, tempPath = tempfile.mkstemp(suffix='.tmp', dir=directory)
+            try:
+                with os.fdopen(handle, 'w', encoding='utf-8') as file:
+                    json.dump(self.ratios, file)
+                os.replace(tempPath, self.path)
+            except BaseException:
+                if os.path.exists(tempPath):
+                    os.remove(tempPath)
+                raise
+
+
+_memoryHistory = {}
+_memoryHistoryLock = threading.Lock()
+
+
+def memoryHistory():
+
+    # Одна история на процесс, чтобы потоки не затирали замеры друг друга
+
+    path = cacheDir()
+    if path is not None:
+        path = os.path.join(path, 'memory.json')
+
+    with _memoryHistoryLock:
+        if path not in _memoryHistory:
+            _memoryHistory[path] = MemoryHistory(path)
+        return _memoryHistory[path]
+
+
+def _scheduledTask(func, args, measure):
+
+    # Выполняется в процессе пула, пик памяти замеряется выборочно.
+    # В пуле потоков tracemalloc видел бы чужие задачи - там не замеряем.
+    # Что задача записала во временные каталоги процесса пула, ее
+    # счетчики и время этапов запуска возвращаются вместе с результатом
+
+    if current_process().name == 'MainProcess':
+        return profiledCall(func, *args), None, None
+
+    storage = scratch()
+    written, directories = storage.usage()
+    record = runWorkerStart()
+
+    if measure:
+        tracemalloc.start()
+    try:
+        result = profiledCall(func, *args)
+        peak = tracemalloc.get_traced_memory()[1] if measure else None
+    finally:
+        if measure:
+            tracemalloc.stop()
+
+    after = storage.usage()
+    usage = {'scratch': [after[0] - written, after[1] - directories],
+             'run': {'counters': record['counters'],
+                     'stages': record['stages']}}
+
+    return result, peak, usage
+
+
+def mergeWorkerUsage(usage):
+
+    # Учет в основном процессе того, что сделала задача в процессе пула
+
+    if usage is None:
+        return
+
+    scratch().addUsage(*usage['scratch'])
+    runMerge(usage['run'])
+
+
+class MemoryAdmission:
+
+    # Учет выполняемых задач и их оценок памяти, общий для всех
+    # планировщиков одного пула. Изменения под self.changed
+
+    def __init__(self, workers, budget):
+        self.workers = workers
+        self.budget = budget
+        self.running = 0
+        self.used = 0
+        self.changed = threading.Condition()
+
+    def acquire(self, estimate):
+
+        # Вызывается под self.changed. Задача, которая одна больше
+        # бюджета, допускается, когда других задач нет
+
+        if self.running >= self.workers:
+            return False
+        if (self.running and self.budget is not None and
+                self.used + estimate > self.budget):
+            return False
+
+        self.running = self.running + 1
+        self.used = self.used + estimate
+        return True
+
+    def release(self, estimate):
+
+        with self.changed:
+            self.running = self.running - 1
+            self.used = self.used - estimate
+            self.changed.notify_all()
+
+
+_admissions = weakref.WeakKeyDictionary()
+_admissionsLock = threading.Lock()
+
+
+def poolAdmission(pool):
+
+    # Один учет на пул: обработки, которые параллельно отдают формы
+    # в общий пул, делят между собой его процессы и бюджет памяти
+
+    with _admissionsLock:
+        admission = _admissions.get(pool)
+        if admission is None:
+            workers = getattr(pool, '_processes', None) or os.cpu_count()
+            admission = MemoryAdmission(workers, memoryBudget())
+            _admissions[pool] = admission
+        return admission
+
+
+class FormScheduler:
+    '''Запуск задач по формам в пуле с учетом памяти: одновременно
+       выполняется не больше задач, чем процессов пула, и сумма оценок
+       памяти не превышает бюджет. Учет общий для всех планировщиков
+       пула, с явным budget - свой. Задача, которая одна больше
+       бюджета, выполняется, когда других задач нет. Крупные формы
+       запускаются первыми, пока они ждут памяти, идут мелкие
+    '''
+
+    def __init__(self, pool, budget=None, history=None):
+        self.pool = pool
+        self.history = history if history is not None else memoryHistory()
+        if budget is None:
+            self.admission = poolAdmission(pool)
+        else:
+            workers = getattr(pool, '_processes', None) or os.cpu_count()
+            self.admission = MemoryAdmission(workers, budget)
+        self.budget = self.admission.budget
+        self.workers = self.admission.workers
+
+    def run(self, func, tasks, prepare=None, finish=None):
+        '''func(*args) для каждого кортежа args из tasks,
+           первый аргумент - путь к файлу формы. Результаты по порядку.
+           prepare(args) вызывается, когда задача допущена, и возвращает
+           аргументы для func (None - задачу не выполнять), finish(args)
+           с этими аргументами - после выполнения задачи
+        '''
+
+        kind = func.__name__
+        external = kind in MEMORY_EXTERNAL_TASKS
+        if external:
+            ratio = MEMORY_RATIO_EXTERNAL
+        else:
+            ratio = self.history.ratio(kind)
+
+        sizes = []
+        for args in tasks:
+            try:
+                sizes.append(os.path.getsize(args[0]))
+            except OSError:
+                sizes.append(0)
+        estimates = [int(size * ratio) for size in sizes]
+
+        waiting = sorted(range(len(tasks)), key=lambda i: -sizes[i])
+        results = [None] * len(tasks)
+        prepared = {}
+        finished = queue.Queue()
+        samples = []
+        errors = []
+        running = 0
+        submitted = 0
+
+        admission = self.admission
+
+        def submit(index, args, measure):
+
+            def done(result):
+                admission.release(estimates[index])
+                finished.put((index, result, None))
+
+            def failed(error):
+                admission.release(estimates[index])
+                finished.put((index, None, error))
+
+            self.pool.apply_async(_scheduledTask,
+                                  (func, args, measure),
+                                  callback=done, error_callback=failed)
+
+        while waiting or running:
+
+            # Допускаем задачи, пока хватает процессов и бюджета
+
+            admitted = []
+            with admission.changed:
+                i = 0
+                while i < len(waiting) and not errors:
+                    index = waiting[i]
+
+                    if not admission.acquire(estimates[index]):
+                        if admission.running >= admission.workers:
+                            break
+                        i = i + 1
+                        continue
+
+                    admitted.append(waiting.pop(i))
+
+                # Своих задач нет, пул занят задачами других планировщиков
+
+                if not running and not admitted:
+                    if not waiting or errors:
+                        break
+                    admission.changed.wait()
+                    continue
+
+            # Подготовка допущенных задач - вне блокировки
+
+            for k, index in enumerate(admitted):
+                try:
+                    args = tasks[index]
+                    if prepare is not None:
+                        args = prepare(args)
+                except Exception as error:
+                    for rest in admitted[k:]:
+                        admission.release(estimates[rest])
+                    errors.append(error)
+                    break
+
+                if args is None:
+                    admission.release(estimates[index])
+                    continue
+
+                prepared[index] = args
+                submit(index, args, not external and
+                       submitted % MEMORY_SAMPLE_EVERY == 0)
+                submitted = submitted + 1
+                running = running + 1
+
+            if not running:
+                continue
+
+            index, result, error = finished.get()
+            running = running - 1
+
+            if finish is not None:
+                finish(prepared.pop(index))
+
+            if error is not None:
+                errors.append(error)
+                continue
+
+            results[index], peak, usage = result
+            mergeWorkerUsage(usage)
+            if peak is not None and sizes[index]:
+                samples.append(peak / sizes[index])
+
+        if not external:
+            self.history.update(kind, samples)
+            self.history.save()
+
+        if errors:
+            raise errors[0]
+
+        return results
+
+
+##########################################
+#
+# История запусков
+#
+#########################################
+
+# Каждый запуск команды дописывает строку JSON в history.jsonl каталога
+# кэша: команда, время этапов, счетчики (обработки, формы, байты,
+# попадания в кэш), пик памяти, версии платформы и python.
+# Время этапов суммируется по всем обработкам запуска
+
+HISTORY_FILE = 'history.jsonl'
+
+_runRecord = None
+_runLock = threading.Lock()
+
+
+def historyPath():
+
+    path = cacheDir()
+    if path is None:
+        return None
+
+    return os.path.join(path, HISTORY_FILE)
+
+
+def runStart(command, **details):
+
+    global _runRecord
+
+    _runRecord = {
+        'command': command,
+        'started': time.time(),
+        'python': sys.version.split()[0],
+        'os': sys.platform,
+        'enterpriseVersion': None,
+        'stages': {},
+        'counters': {},
+    }
+    _runRecord.update(details)
+
+    return _runRecord
+
+
+def runSet(name, value):
+
+    if _runRecord is not None:
+        with _runLock:
+            _runRecord[name] = value
+
+
+def runCount(name, value=1):
+
+    if _runRecord is not None:
+        with _runLock:
+            counters = _runRecord['counters']
+            counters[name] = counters.get(name, 0) + value
+
+
+@contextlib.contextmanager
+def runStage(name):
+
+    begin = time.perf_counter()
+    try:
+        yield
+    finally:
+        if _runRecord is not None:
+            seconds = time.perf_counter() - begin
+            with _runLock:
+                stages = _runRecord['stages']
+                stages[name] = stages.get(name, 0) + seconds
+
+
+def peakRss():
+
+    # Пик памяти процесса и дочерних процессов (пул, конфигуратор), байт
+
+    try:
+        import resource
+    except ImportError:
+        resource = None
+
+    if resource is not None:
+        scale = 1 if sys.platform == 'darwin' else 1024
+        own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        return {'self': own * scale, 'children': children * scale}
+
+    if sys.platform == 'win32':
+        import ctypes
+        from ctypes import wintypes
+
+        class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+            _fields_ = [('cb', wintypes.DWORD),
+                        ('PageFaultCount', wintypes.DWORD),
+                        ('PeakWorkingSetSize', ctypes.c_size_t),
+                        ('WorkingSetSize', ctypes.c_size_t),
+                        ('QuotaPeakPagedPoolUsage', ctypes.c_size_t),
+                        ('QuotaPagedPoolUsage', ctypes.c_size_t),
+                        ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t),
+                        ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+                        ('PagefileUsage', ctypes.c_size_t),
+                        ('PeakPagefileUsage', ctypes.c_size_t)]
+
+        counters = PROCESS_MEMORY_COUNTERS()
+        counters.cb = ctypes.sizeof(counters)
+        process = ctypes.windll.kernel32.GetCurrentProcess()
+        if ctypes.windll.psapi.GetProcessMemoryInfo(
+                process, ctypes.byref(counters), counters.cb):
+            return {'self': counters.PeakWorkingSetSize, 'children': None}
+
+    return None
+
+
+def runWorkerStart():
+
+    # В процессе пула счетчики и время этапов задачи копятся в своей
+    # записи и возвращаются основному процессу вместе с результатом
+
+    global _runRecord
+
+    _runRecord = {'counters': {}, 'stages': {}}
+    return _runRecord
+
+
+def runMerge(record):
+
+    # Счетчики и время этапов задачи из процесса пула
+
+    if _runRecord is None:
+        return
+
+    with _runLock:
+        for key in ('counters', 'stages'):
+            values = _runRecord[key]
+            for name, value in record[key].items():
+                values[name] = values.get(name, 0) + value
+
+
+def runFinish(error=None):
+
+    global _runRecord
+
+    record = _runRecord
+    _runRecord = None
+    if record is None:
+        return None
+
+    record['seconds'] = time.time() - record['started']
+    record['peakRss'] = peakRss()
+    record['error'] = None if error is None else str(error)
+
+    path = historyPath()
+    if path is not None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'a', encoding='utf-8') as file:
+            file.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+    return record
+
+
+def readHistory(path=None):
+
+    path = path or historyPath()
+    if path is None or not os.path.exists(path):
+        return []
+
+    records = []
+    with open(path, 'r', encoding='utf-8') as file:
+        for line in file:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                # Строка недописанного запуска
+                continue
+
+    return records
+
+
+def percentile(values, p):
+
+    # Процентиль по ближайшему рангу
+
+    values = sorted(values)
+    if not values:
+        return None
+
+    rank = max(int(math.ceil(p / 100 * len(values))), 1)
+    return values[rank - 1]
+
+
+def historyMetrics(record):
+
+    # Время запуска целиком и по этапам
+
+    metrics = {'всего': record.get('seconds', 0)}
+    for name, seconds in record.get('stages', {}).items():
+        metrics[name] = seconds
+    return metrics
+
+
+def historyStats(records, command=None, window=10, threshold=0.2):
+    '''Процентили времени по командам и этапам, регрессии: медиана
+       последних window запусков больше медианы предыдущих window
+       запусков более чем на threshold, и медианы по версиям платформы
+    '''
+
+    result = []
+    groups = {}
+    for record in records:
+        if record.get('error') is not None:
+            continue
+        if command is not None and record.get('command') != command:
+            continue
+        groups.setdefault(record.get('command'), []).append(record)
+
+    for name, group in sorted(groups.items(), key=lambda x: str(x[0])):
+        group.sort(key=lambda x: x.get('started', 0))
+
+        metrics = {}
+        for record in group:
+            for metric, seconds in historyMetrics(record).items():
+                metrics.setdefault(metric, []).append(seconds)
+
+        stats = {'command': name, 'runs': len(group), 'metrics': {},
+                 'regressions': [], 'platforms': {}}
+
+        for metric, values in metrics.items():
+            stats['metrics'][metric] = {p: percentile(values, p)
+                                        for p in (50, 90, 99)}
+
+            recent = values[-window:]
+            previous = values[-2 * window:-window]
+            if recent and previous:
+                before = percentile(previous, 50)
+                after = percentile(recent, 50)
+                if before and after > before * (1 + threshold):
+                    stats['regressions'].append((metric, before, after))
+
+        for record in group:
+            version = record.get('enterpriseVersion') or '-'
+            stats['platforms'].setdefault(version, []).append(
+                record.get('seconds', 0))
+        for version, values in stats['platforms'].items():
+            stats['platforms'][version] = (len(values),
+                                           percentile(values, 50))
+
+        result.append(stats)
+
+    return result
+
+
+def printHistoryStats(stats):
+
+    if not stats:
+        print('..История запусков пуста.')
+        return
+
+    for item in stats:
+        print(f'..{item["command"]}: запусков {item["runs"]}')
+
+        for metric, values in item['metrics'].items():
+            print(f'....{metric}: p50 {values[50]:.1f} с,'
+                  f' p90 {values[90]:.1f} с, p99 {values[99]:.1f} с')
+
+        if len(item['platforms']) > 1:
+            for version, (runs, median) in sorted(item['platforms'].items()):
+                print(f'....платформа {version}: запусков {runs},'
+                      f' медиана {median:.1f} с')
+
+        for metric, before, after in item['regressions']:
+            print(f'....Замедление {metric}: медиана {before:.1f} с'
+                  f' -> {after:.1f} с (+{(after / before - 1) * 100:.0f}%)')
+
+
+##########################################
+#
+# Каталог репозитория
+#
+#########################################
+
+# Обработки проекта, их xml и каталоги исходников, файлы исходников с id
+# объектов git (хэши содержимого). Хранится в SQLite в каталоге .git,
+# при каждом запуске сверяется с индексом git и обновляются только
+# изменившиеся записи. Пути в каталоге - от корня проекта, через "/"
+
+CATALOG_VERSION = 1
+
+
+def catalogKind(path):
+
+    name = os.path.basename(path)
+    if name == 'form.prettydata':
+        return 'form'
+    if name.endswith('.bsl'):
+        return 'module'
+    if name.endswith('.xml'):
+        return 'xml'
+    return 'file'
+
+
+class RepoCatalog:
+
+    def __init__(self, root, dbPath):
+        self.root = os.path.abspath(root)
+        self.path = dbPath
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(dbPath), exist_ok=True)
+        self._db = sqlite3.connect(dbPath, check_same_thread=False)
+        self._create()
+
+    def _create(self):
+
+        with self._db:
+            self._db.executescript('''
+                CREATE TABLE IF NOT EXISTS meta (
+                    key TEXT PRIMARY KEY, value TEXT);
+                CREATE TABLE IF NOT EXISTS epf (
+                    path TEXT PRIMARY KEY, object TEXT,
+                    xml TEXT, src_root TEXT);
+                CREATE INDEX IF NOT EXISTS epf_xml ON epf (xml);
+                CREATE INDEX IF NOT EXISTS epf_src_root ON epf (src_root);
+                CREATE TABLE IF NOT EXISTS source (
+                    path TEXT PRIMARY KEY, object TEXT,
+                    epf TEXT, kind TEXT);
+                CREATE INDEX IF NOT EXISTS source_epf ON source (epf, kind);
+            ''')
+
+            row = self._db.execute(
+                "SELECT value FROM meta WHERE key = 'version'").fetchone()
+            if row is None or row[0] != str(CATALOG_VERSION):
+                self._db.execute('DELETE FROM epf')
+                self._db.execute('DELETE FROM source')
+                self._db.execute(
+                    "INSERT OR REPLACE INTO meta VALUES ('version', ?)",
+                    (str(CATALOG_VERSION),))
+
+    def _rel(self, path):
+
+        return pathlib.Path(
+            os.path.relpath(os.path.abspath(path), self.root)).as_posix()
+
+    def _abs(self, rel):
+
+        return os.path.normpath(os.path.join(self.root, rel))
+
+    def _query(self, sql, params=()):
+
+        with self._lock:
+            return self._db.execute(sql, params).fetchall()
+
+    def refresh(self, index=None):
+        '''Сверка с индексом git (и неотслеживаемыми обработками),
+           пишутся только изменения. index - результат git_index_entries
+        '''
+
+        if index is None:
+            index = git_index_entries(self.root)
+
+        epfs = {name: objectId for name, objectId in index.items()
+                if name.endswith('.epf')}
+
+        # Новые обработки еще не в индексе - ключ по размеру и времени
+
+        for name in git_untracked(self.root, '*.epf'):
+            try:
+                stat = os.stat(self._abs(name))
+            except OSError:
+                continue
+            epfs[name] = f'untracked:{stat.st_size}:{stat.st_mtime_ns}'
+
+        with self._lock, self._db:
+            db = self._db
+
+            known = dict(db.execute('SELECT path, object FROM epf'))
+            db.executemany('DELETE FROM epf WHERE path = ?',
+                           [(name,) for name in known if name not in epfs])
+
+            for name, objectId in epfs.items():
+                if name not in known:
+                    epf = self._abs(name)
+                    db.execute('INSERT INTO epf VALUES (?, ?, ?, ?)', (
+                        name, objectId,
+                        self._rel(getXmlpathForEpf(epf, self.root)),
+                        self._rel(getSrcRootpathForEpf(epf, self.root))))
+                elif known[name] != objectId:
+                    db.execute('UPDATE epf SET object = ? WHERE path = ?',
+                               (objectId, name))
+
+            # Владелец файла исходников - обработка, в каталоге
+            # исходников которой он лежит, или чей это xml
+
+            roots = {}
+            for name, xml, srcRoot in db.execute(
+                    'SELECT path, xml, src_root FROM epf'):
+                roots[srcRoot] = name
+                roots[xml] = name
+
+            sources = {}
+            for name, objectId in index.items():
+                owner = roots.get(name)
+                parent = name
+                while owner is None and '/' in parent:
+                    parent = parent.rsplit('/', 1)[0]
+                    owner = roots.get(parent)
+                if owner is not None:
+                    sources[name] = (objectId, owner)
+
+            known = {name: (objectId, owner) for name, objectId, owner in
+                     db.execute('SELECT path, object, epf FROM source')}
+            db.executemany('DELETE FROM source WHERE path = ?',
+                           [(name,) for name in known
+                            if name not in sources])
+            db.executemany(
+                'INSERT OR REPLACE INTO source VALUES (?, ?, ?, ?)',
+                [(name, objectId, owner, catalogKind(name))
+                 for name, (objectId, owner) in sources.items()
+                 if known.get(name) != (objectId, owner)])
+
+    def epfs(self, under=None):
+
+        # Обработки проекта (абсолютные пути), under - только в каталоге
+
+        result = [self._abs(name) for name, in
+                  self._query('SELECT path FROM epf ORDER BY path')]
+
+        if under is not None:
+            under = pathlib.Path(os.path.abspath(under))
+            result = [epf for epf in result
+                      if under in pathlib.Path(epf).parents]
+
+        return result
+
+    def xml(self, epf):
+
+        rows = self._query('SELECT xml FROM epf WHERE path = ?',
+                           (self._rel(epf),))
+        if rows:
+            return self._abs(rows[0][0])
+        return getXmlpathForEpf(epf, self.root)
+
+    def owner(self, path):
+
+        # Обработка, к исходникам которой относится файл, None - ни к какой
+
+        rel = self._rel(path)
+
+        rows = self._query('SELECT epf FROM source WHERE path = ?', (rel,))
+        if not rows:
+            rows = self._query('SELECT path FROM epf WHERE xml = ?', (rel,))
+
+        # Файла еще нет в индексе - ищем каталог исходников среди родителей
+
+        parent = rel
+        while not rows and '/' in parent:
+            parent = parent.rsplit('/', 1)[0]
+            rows = self._query('SELECT path FROM epf WHERE src_root = ?',
+                               (parent,))
+
+        return self._abs(rows[0][0]) if rows else None
+
+    def close(self):
+
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def repoCatalog(root, index=None):
+
+    # Обновленный каталог проекта, None - проект не в репозитории git
+
+    gitDir = git_dir(root)
+    if gitDir is None:
+        return None
+
+    key = os.path.normcase(os.path.abspath(root))
+    name = 'catalog-' + hashlib.sha1(key.encode('utf-8')).hexdigest()[:12]
+    catalog = RepoCatalog(root, os.path.join(gitDir, 'unpackpy',
+                                             name + '.sqlite'))
+
+    with runStage('catalog'):
+        catalog.refresh(index)
+
+    return catalog
+
+
+##########################################
+#
+# Профилирование
+#
+#########################################
+
+# С --profile каждый процесс (основной и процессы пула) пишет в
+# <каталог>/parts профиль cProfile и свернутые стеки выборочного
+# профилировщика. В конце запуска они сливаются в profile.pstats
+# и profile.collapsed (формат flamegraph.pl / speedscope).
+# cProfile видит только главный поток процесса, выборка - все потоки
+
+PROFILE_DIR_ENV = 'UNPACKPY_PROFILE_DIR'
+PROFILE_INTERVAL = 0.005
+
+
+class StackSampler:
+
+    # Раз в interval секунд запоминает стеки всех потоков процесса
+
+    def __init__(self, interval=PROFILE_INTERVAL):
+        self.interval = interval
+        self.counts = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+
+        self._thread.start()
+
+    def stop(self):
+
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} '
+                                 f'({os.path.basename(code.co_filename)}'
+                                 f':{code.co_firstlineno})')
+                    frame = frame.f_back
+
+                key = ';'.join(reversed(stack))
+                self.counts[key] = self.counts.get(key, 0) + 1
+
+    def write(self, path):
+
+        counts = dict(self.counts)
+        with open(path, 'w', encoding='utf-8') as file:
+            for stack, count in counts.items():
+                file.write(f'{stack} {count}\n')
+
+
+class ProcessProfiler:
+
+    # Профиль одного процесса, после каждой задачи сохраняется
+    # целиком: процессы пула завершаются без предупреждения
+
+    def __init__(self, path):
+        self.path = path
+        self.pid = os.getpid()
+        self.profile = cProfile.Profile()
+        self.sampler = StackSampler()
+        self.sampler.start()
+
+    def run(self, func, *args):
+
+        self.profile.enable()
+        try:
+            return func(*args)
+        finally:
+            self.profile.disable()
+            self.save()
+
+    def save(self):
+
+        os.makedirs(self.path, exist_ok=True)
+        name = os.path.join(self.path, str(os.getpid()))
+
+        self.profile.dump_stats(name + '.prof.tmp')
+        os.replace(name + '.prof.tmp', name + '.prof')
+
+        self.sampler.write(name + '.collapsed.tmp')
+        os.replace(name + '.collapsed.tmp', name + '.collapsed')
+
+
+_processProfiler = {}
+
+
+def processProfiler():
+
+    # Профилировщик процесса, None - профилирование не включено
+
+    path = os.environ.get(PROFILE_DIR_ENV)
+    if not path:
+        return None
+
+    # Процесс пула, созданный через fork, получает копию профилировщика
+    # родителя вместе с его данными - заводим свой
+
+    profiler = _processProfiler.get(path)
+    if profiler is None or profiler.pid != os.getpid():
+        _processProfiler[path] = ProcessProfiler(os.path.join(path, 'parts'))
+
+    return _processProfiler[path]
+
+
+def profiledCall(func, *args):
+
+    # Вызов в процессе пула под профилировщиком, если он включен.
+    # В пуле потоков профиль ведет основной процесс
+
+    if current_process().name != 'MainProcess':
+        profiler = processProfiler()
+        if profiler is not None:
+            return profiler.run(func, *args)
+
+    return func(*args)
+
+
+def mergeProfiles(path):
+
+    # Слияние профилей всех процессов запуска
+
+    parts = os.path.join(path, 'parts')
+    names = sorted(os.listdir(parts)) if os.path.isdir(parts) else []
+
+    profiles = [os.path.join(parts, x) for x in names if x.endswith('.prof')]
+    if profiles:
+        stats = pstats.Stats(*profiles)
+        stats.dump_stats(os.path.join(path, 'profile.pstats'))
+
+    counts = {}
+    for name in names:
+        if not name.endswith('.collapsed'):
+            continue
+        with open(os.path.join(parts, name), 'r', encoding='utf-8') as file:
+            for line in file:
+                stack, _, count = line.rstrip('\n').rpartition(' ')
+                counts[stack] = counts.get(stack, 0) + int(count)
+
+    with open(os.path.join(path, 'profile.collapsed'), 'w',
+              encoding='utf-8') as file:
+        for stack in sorted(counts):
+            file.write(f'{stack} {counts[stack]}\n')
+
+    print(f'..Профиль процессов: {len(profiles)},'
+          f' {os.path.join(path, "profile.pstats")},'
+          f' {os.path.join(path, "profile.collapsed")}.')
+
+
+##########################################
+#
+# Общая память для процессов пула
+#
+#########################################
+
+
+class SharedBuffers:
+    '''Данные для задач пула в общей памяти: родитель кладет буфер один
+       раз, процесс пула читает его через sharedBuffer без копирования.
+       Сегменты удаляются при закрытии, после выполнения задач
+    '''
+
+    def __init__(self):
+        self._segments = {}
+
+    def share(self, data):
+
+        # Описание сегмента (имя, размер) для аргументов задачи
+
+        segment = shared_memory.SharedMemory(create=True,
+                                             size=max(len(data), 1))
+        segment.buf[:len(data)] = data
+        self._segments[segment.name] = segment
+
+        return (segment.name, len(data))
+
+    def release(self, shared):
+
+        # Сегмент выполненной задачи больше не нужен
+
+        segment = self._segments.pop(shared[0])
+        segment.close()
+        segment.unlink()
+
+    def close(self):
+
+        for segment in self._segments.values():
+            segment.close()
+            segment.unlink()
+        self._segments = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _attachSegment(name):
+
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+
+    if os.name != 'posix' or current_process().name == 'MainProcess':
+        return shared_memory.SharedMemory(name=name)
+
+    # До Python 3.13 подключение регистрирует сегмент в resource_tracker,
+    # и процесс пула при выходе удалил бы чужой сегмент: снимаем с учета
+
+    from multiprocessing import resource_tracker
+
+    segment = shared_memory.SharedMemory(name=name)
+    resource_tracker.unregister(segment._name, 'shared_memory')
+    return segment
+
+
+@contextlib.contextmanager
+def sharedBuffer(shared):
+
+    # memoryview данных сегмента из SharedBuffers.share,
+    # действителен только внутри with
+
+    name, size = shared
+    segment = _attachSegment(name)
+    view = segment.buf[:size]
+    try:
+        yield view
+    finally:
+        view.release()
+        segment.close()
+
+
+##########################################
+#
+# Сборка разборка
+#
+#########################################
+
+
+def unpackForms(formpath, v8unpackpath):
+
+    v8unpackpath = os.path.normpath(v8unpackpath)
+    formpath = os.path.normpath(formpath)
+    formdir = os.path.dirname(formpath)
+
+    сmdStr = f'""{v8unpackpath}" -U "{formpath}" "{formdir}""'
+    result = os.system(сmdStr)
+
+    if result != 0:
+        Exception(f'Не удалось разобрать форму {formpath}')
+
+    return result
+
+
+def afterUnpackForms(formPath):
+    '''Обработка исходников после сборки обработки,
+       удаление бинарников,
+       переименования
+    '''
+
+    formDirName = os.path.dirname(formPath)
+    moduleBsl = os.path.normpath(formDirName + '/module.bsl')
+    moduleData = os.path.normpath(formDirName + '/module.data')
+
+    os.rename(moduleData, moduleBsl)
+
+    formDataPath = os.path.normpath(formDirName + '/form.data')
+    formPrettyDataPath = os.path.normpath(formDirName + '/form.prettydata')
+
+    newForm = Form(formDataPath, lazy=True)
+    newForm.read()
+    newForm.removeShit()
+    newForm.writePretty(formPrettyDataPath)
+
+    for file in ['FileHeader',
+                 'Form.bin',
+                 'form.header',
+                 'module.header',
+                 'form.data']:
+        filePath = os.path.normpath(formDirName + '/' + file)
+        if os.path.exists(filePath):
+            os.remove(filePath)
+
+
+def readFormBin(formPath):
+    '''Данные элементов form и module из Form.bin (то же, что пишет
+       v8unpack -U в form.data и module.data), None - контейнер не
+       разобрать
+    '''
+
+    with open(formPath, 'rb') as file:
+        buffer = file.read()
+
+    try:
+        elements = {element['name']: element['data']
+                    for element in readV8Container(buffer)}
+    except (ValueError, struct.error):
+        return None
+
+    if 'form' not in elements or 'module' not in elements:
+        return None
+    if isV8Container(elements['form']):
+        return None
+
+    return elements['form'], elements['module']
+
+
+def afterUnpackSharedForm(formPath, shared):
+    '''То же, что afterUnpackForms для формы, данные которой прочитаны
+       из Form.bin родителем и переданы в общей памяти (SharedBuffers),
+       module.bsl родитель уже записал
+    '''
+
+    formDirName = os.path.dirname(formPath)
+    formPrettyDataPath = os.path.join(formDirName, 'form.prettydata')
+
+    newForm = Form(os.path.join(formDirName, 'form.data'))
+    with sharedBuffer(shared) as buffer:
+        newForm.readBufferCached(buffer)
+    newForm.removeShit()
+    newForm.writePretty(formPrettyDataPath)
+
+    os.remove(formPath)
+
+
+def packForms(formPath, v8unpackpath):
+
+    formDirName = os.path.dirname(formPath)
+
+    formDataPath = os.path.normpath(formDirName + '/form.data')
+    formPrettyDataPath = os.path.normpath(formDirName + '/form.prettydata')
+
+    # Генерация файлов для unpack из исходников
+
+    prettyToCompact(formPrettyDataPath, formDataPath)
+
+    # Генерация заголовков
+
+    fileHeaderPath = os.path.normpath(formDirName + '/FileHeader')
+    FileHeaderHex = binascii.unhexlify('FFFFFF7F000200000200000000000000')
+
+    FileHeader = open(fileHeaderPath, 'wb')
+    FileHeader.write(FileHeaderHex)
+    FileHeader.close()
 
     formHeaderPath = os.path.normpath(formDirName + '/form.header')
     FormHeaderHex = binascii.unhexlify(
@@ -767,7 +4166,8 @@ def packForms(formPath, v8unpackpath):
         raise Exception('Не удалось собрать ' + formDirName)
 
 
-def build(epf, xml, v8unpack, enterpriseVersion=None, useThreadPool=False):
+def build(epf, xml, v8unpack, enterpriseVersion=None, useThreadPool=False,
+          pool=None):
 
     # Подготовка окружения
     print('..Готовим окружение.', end="\r")
@@ -775,8 +4175,13 @@ def build(epf, xml, v8unpack, enterpriseVersion=None, useThreadPool=False):
     if os.path.exists(epf):
         os.remove(epf)
 
-    with tempfile.TemporaryDirectory() as tempdir:
-        copy_tree(os.path.dirname(xml), tempdir)
+    srcSize = treeSize(os.path.dirname(xml))
+    runCount('epf')
+    runCount('bytes', srcSize)
+
+    with scratch().directory('src-', 2 * srcSize) as tempdir:
+        with runStage('build.copy'):
+            copy_tree(os.path.dirname(xml), tempdir)
         xml = os.path.join(tempdir, os.path.basename(xml))
 
         Enterprise = EnterpriseManager(enterpriseVersion)
@@ -785,141 +4190,859 @@ def build(epf, xml, v8unpack, enterpriseVersion=None, useThreadPool=False):
         # Собрать обычные формы в form.bin
         print('..Восстанавливаем обычные формы.', end="\r")
 
-        if useThreadPool:
-            with ThreadPool() as pool:
-                pool.starmap(packForms,
-                             zip(srcForms,
-                                 itertools.repeat(v8unpack)
-                                 )
-                             )
+        tasks = [(form, v8unpack) for form in srcForms]
+        runCount('forms', len(srcForms))
+
+        with runStage('build.forms'):
+            if pool is not None:
+                FormScheduler(pool).run(packForms, tasks)
+
+            elif useThreadPool:
+                with ThreadPool() as pool:
+                    FormScheduler(pool).run(packForms, tasks)
+
+            else:
+                with Pool() as pool:
+                    FormScheduler(pool).run(packForms, tasks)
+
+        # Собрать исходники в epf
+        print(f'..Создаем обработку "{epf}" из "{xml}".')
+
+        Enterprise.epfBuid(xml, epf)
+
+        print('..Успешно завершено')
+
+
+# Модули, которые можно заменить прямо в контейнере обработки
+
+_metadataUuidPattern = re.compile(
+    rb'uuid="([0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-'
+    rb'[0-9a-fA-F]{4}-[0-9a-fA-F]{12})"')
+
+
+def metadataUuid(xml):
+
+    # Первый uuid в описании объекта - uuid самого объекта
+
+    with open(xml, 'rb') as file:
+        match = _metadataUuidPattern.search(file.read())
+
+    return match.group(1).decode('ascii').lower() if match else None
+
+
+def epfModuleElement(xml, moduleFile):
+    '''Путь элемента контейнера обработки для файла модуля из исходников,
+       None - модуль не заменить без конфигуратора
+    '''
+
+    srcRoot = os.path.splitext(os.path.abspath(xml))[0]
+    parts = pathlib.Path(os.path.relpath(moduleFile, srcRoot)).parts
+
+    # Модуль объекта: <uuid обработки>.0/text
+
+    if parts == ('Ext', 'ObjectModule.bsl'):
+        uuid = metadataUuid(xml)
+        return f'{uuid}.0/text' if uuid else None
+
+    # Модуль обычной формы лежит в Form.bin: <uuid формы>.0/module
+
+    if (len(parts) == 4 and parts[0] == 'Forms' and
+            parts[2:] == ('Ext', 'module.bsl')):
+        formXml = os.path.join(srcRoot, 'Forms', parts[1] + '.xml')
+        if not os.path.exists(formXml):
+            return None
+        uuid = metadataUuid(formXml)
+        return f'{uuid}.0/module' if uuid else None
+
+    return None
+
+
+def patchEpfModules(epf, xml, changes, repo_root):
+    '''Замена измененных модулей прямо в epf, без конфигуратора.
+       changes - список (статус git, путь) исходников обработки.
+       False - нужна полная сборка
+    '''
+
+    if not changes or not os.path.exists(epf):
+        return False
+
+    replacements = {}
+
+    for status, file in changes:
+
+        # Добавление, удаление, изменение не модуля - менялась структура
+
+        if status != 'M':
+            return False
+
+        element = epfModuleElement(xml, file)
+        if element is None:
+            return False
+
+        head = git_file_content(file, 'HEAD', repo_root)
+        staged = git_file_content(file, '', repo_root)
+        if head is None or staged is None:
+            return False
+
+        replacements[element] = (head, staged)
+
+    with open(epf, 'rb') as file:
+        buffer = file.read()
+
+    # В обработке должен быть тот же модуль, что в HEAD, иначе
+    # обработка и исходники уже разошлись
+
+    try:
+        for element, (head, staged) in replacements.items():
+            if v8ElementData(buffer, element) != head:
+                return False
+
+        hashes = epfObjectHashes(epf)
+        buffer = patchV8Container(buffer, {
+            element: staged
+            for element, (head, staged) in replacements.items()})
+
+    except (ValueError, struct.error):
+        return False
+
+    print(f'..Заменяем модули в обработке "{epf}" без сборки.')
+    runCount('epf.patched')
+
+    tempPath = epf + '.tmp'
+    with open(tempPath, 'wb') as file:
+        file.write(buffer)
+    os.replace(tempPath, epf)
+
+    # Разбор обработки по-прежнему не нужен, если он был актуален
+
+    if epfUnchanged(xml, hashes, [file for status, file in changes]):
+        saveEpfManifest(xml, epfObjectHashes(epf))
+
+    return True
+
+
+def unpack(epf, xml, v8unpack, enterpriseVersion=None, pool=None,
+           buffer=None):
+
+    # buffer - содержимое обработки (например, из индекса git),
+    # тогда файл epf не читается
+
+    print(f'..Разбираем обработку "{epf}" в "{xml}".')
+
+    # Конфигуратор не нужен, если содержимое объектов не изменилось
+
+    runCount('epf')
+
+    hashes = epfObjectHashes(epf, buffer)
+    if epfUnchanged(xml, hashes):
+        runCount('cache.epf.hit')
+        print('..Содержимое обработки не изменилось, выгрузка пропущена.')
+        return
+    runCount('cache.epf.miss')
+
+    Enterprise = EnterpriseManager(enterpriseVersion)
+
+    # Грубая оценка: исходники в разы больше сжатой обработки
+
+    if buffer is None:
+        size = os.path.getsize(epf)
+    else:
+        size = len(buffer)
+    runCount('bytes', size)
+    estimate = EPF_DUMP_RATIO * size
+
+    # Выгружаем во временный каталог, в исходники переносим только отличия
+
+    with scratch().directory('staging-', estimate) as tempdir:
+
+        # Конфигуратор читает обработку только из файла
+
+        if buffer is not None:
+            os.makedirs(os.path.join(tempdir, 'epf'))
+            epf = os.path.join(tempdir, 'epf', os.path.basename(epf))
+            with open(epf, 'wb') as file:
+                file.write(buffer)
+
+        # Выгрузка обработки в XML формат
+
+        stagingXml = os.path.join(tempdir, os.path.basename(xml))
+        Enterprise.epfDump(epf, stagingXml)
+
+        # Распаковка обычных форм в исходники в "Своем формата"
+
+        binariesForms = findFiles(Enterprise.getEpfDumpRoot(stagingXml),
+                                  'Form.bin')
+
+        print('..Разбираем обычные формы.', end="\r")
+        runCount('forms', len(binariesForms))
+
+        with runStage('unpack.forms'):
+            if pool is None:
+                with Pool() as pool:
+                    unpackAllForms(binariesForms, v8unpack, pool)
+            else:
+                unpackAllForms(binariesForms, v8unpack, pool)
+
+        with runStage('unpack.sync'):
+            stats = syncEpfSources(stagingXml, xml)
+
+    saveEpfManifest(xml, hashes)
+
+    print(f'..Изменено файлов: {stats["written"]},'
+          f' удалено: {stats["deleted"]}.')
+    print(
+        f'..Успешно завершено. Обработано: {len(binariesForms)} обычных форм.')
+
+
+def unpackAllForms(binariesForms, v8unpack, pool):
+
+    scheduler = FormScheduler(pool)
+
+    # Form.bin читается один раз здесь, когда планировщик допускает
+    # задачу формы: модуль пишется сразу, данные формы процессы пула
+    # разбирают прямо из общей памяти, после разбора сегмент удаляется.
+    # Формы, контейнер которых не разобрать, разбирает v8unpack
+
+    external = []
+
+    with SharedBuffers() as shared:
+
+        def prepare(args):
+            form, = args
+            elements = readFormBin(form)
+            if elements is None:
+                external.append(form)
+                return None
+
+            formData, moduleData = elements
+            moduleBsl = os.path.join(os.path.dirname(form), 'module.bsl')
+            with open(moduleBsl, 'wb') as file:
+                file.write(moduleData)
+
+            return (form, shared.share(formData))
+
+        def finish(args):
+            shared.release(args[1])
+
+        scheduler.run(afterUnpackSharedForm,
+                      [(form,) for form in binariesForms], prepare, finish)
+
+    scheduler.run(unpackForms, [(form, v8unpack) for form in external])
+    scheduler.run(afterUnpackForms, [(form,) for form in external])
+
+
+def syncFile(src, dst):
+
+    # Копирует файл, только если содержимое отличается. В уже
+    # существующем файле переписываются только отличающиеся блоки
+
+    if not os.path.isfile(dst):
+        os.makedirs(os.path.dirname(dst) or '.', exist_ok=True)
+        shutil.copyfile(src, dst)
+        return True
+
+    if (os.path.getsize(src) == os.path.getsize(dst) and
+            file_hash(src) == file_hash(dst)):
+        return False
+
+    with open(src, 'rb') as file:
+        newData = file.read()
+    with open(dst, 'rb') as file:
+        oldData = file.read()
+
+    patchFile(dst, oldData, newData)
+    return True
+
+
+def syncTree(srcDir, dstDir, stats=None):
+    '''Приводит dstDir к содержимому srcDir:
+       записываются только отличающиеся файлы,
+       удаляются только исчезнувшие
+    '''
+
+    if stats is None:
+        stats = {'written': 0, 'deleted': 0, 'unchanged': 0}
+
+    srcFiles = set()
+    for dirpath, dirnames, filenames in os.walk(srcDir):
+        for filename in filenames:
+            srcPath = os.path.join(dirpath, filename)
+            relPath = os.path.relpath(srcPath, srcDir)
+            srcFiles.add(relPath)
+
+            if syncFile(srcPath, os.path.join(dstDir, relPath)):
+                stats['written'] = stats['written'] + 1
+            else:
+                stats['unchanged'] = stats['unchanged'] + 1
+
+    for dirpath, dirnames, filenames in os.walk(dstDir, topdown=False):
+        for filename in filenames:
+            dstPath = os.path.join(dirpath, filename)
+            if os.path.relpath(dstPath, dstDir) not in srcFiles:
+                os.remove(dstPath)
+                stats['deleted'] = stats['deleted'] + 1
+
+        if dirpath != dstDir and not os.listdir(dirpath):
+            os.rmdir(dirpath)
+
+    return stats
+
+
+def syncEpfSources(srcXml, dstXml):
+
+    # Переносит xml обработки и каталог ее исходников
+
+    stats = {'written': 0, 'deleted': 0, 'unchanged': 0}
+
+    if syncFile(srcXml, dstXml):
+        stats['written'] = stats['written'] + 1
+    else:
+        stats['unchanged'] = stats['unchanged'] + 1
+
+    srcRoot = os.path.splitext(srcXml)[0]
+    dstRoot = os.path.splitext(dstXml)[0]
+
+    if os.path.exists(srcRoot):
+        syncTree(srcRoot, dstRoot, stats)
+    elif os.path.exists(dstRoot):
+        shutil.rmtree(dstRoot)
+
+    return stats
+
+
+def findFiles(path, mask, mask_ignore=".git/"):
+
+    result = []
+
+    for i in pathlib.Path(path).rglob(mask):
+        if mask_ignore not in str(i):
+            result.append(str(i))
+
+    return result
+
+
+def epf_sources(path, repo_root):
+
+    # Обработки в каталоге path и их xml: по каталогу репозитория, без
+    # обхода всего дерева, плюс игнорируемые. Вне git - обходом дерева
+
+    catalog = repoCatalog(repo_root)
+    if catalog is None:
+        return [(epf, getXmlpathForEpf(epf, repo_root))
+                for epf in sorted(findFiles(path, '*.epf'))]
+
+    with catalog:
+        epf_list = catalog.epfs(under=path) + git_ignored_epfs(path)
+        return [(epf, catalog.xml(epf)) for epf in sorted(epf_list)]
+
+
+def unpack_all(path, repo_root, v8unpack, enterpriseVersion=None,
+               manifest=None, shard=None):
+
+    # Работа по списку: можно делить на части и продолжать после сбоя
+
+    if manifest is not None:
+        unpack_manifest(path, repo_root, v8unpack, enterpriseVersion,
+                        manifest, shard)
+        return
+
+    # Разберем все обработки
+
+    for epf, xml in epf_sources(path, repo_root):
+        unpack(epf=epf,
+               xml=xml,
+               v8unpack=v8unpack,
+               enterpriseVersion=enterpriseVersion)
+
+
+def file_hash(path):
+
+    result = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            result.update(chunk)
+
+    return result.hexdigest()
+
+
+def epf_manifest(path, repo_root):
+
+    # Список работ: обработки и их исходники относительно корня репозитория
+
+    items = []
+    for epf, xml in epf_sources(path, repo_root):
+        items.append({
+            'epf': pathlib.Path(os.path.relpath(epf, repo_root)).as_posix(),
+            'xml': pathlib.Path(os.path.relpath(xml, repo_root)).as_posix(),
+            'hash': file_hash(epf)
+        })
+
+    return items
+
+
+def read_manifest(manifest):
+
+    with open(manifest, 'r', encoding='utf-8') as file:
+        return json.load(file)
+
+
+def write_manifest(manifest, items):
+
+    with open(manifest, 'w', encoding='utf-8') as file:
+        json.dump(items, file, ensure_ascii=False, indent=2)
+
+
+def parse_shard(value):
+
+    # "i/N", части нумеруются с единицы
+
+    try:
+        index, count = [int(x) for x in value.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"ожидается i/N, получено {value}")
+
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError(f"неверный номер части {value}")
+
+    return index, count
+
+
+def shard_of(epf, count):
+
+    # Номер части (с нуля) не зависит от состава списка и порядка обхода
+
+    digest = hashlib.sha1(epf.encode('utf-8')).hexdigest()
+    return int(digest, 16) % count
+
+
+def read_journal(journal):
+
+    finished = {}
+
+    if os.path.exists(journal):
+        with open(journal, 'r', encoding='utf-8') as file:
+            for line in file:
+                # Последняя строка может быть недописана при сбое
+                try:
+                    item = json.loads(line)
+                except ValueError:
+                    continue
+                finished[item['epf']] = item['hash']
+
+    return finished
+
+
+def append_journal(journal, item):
+
+    with open(journal, 'a', encoding='utf-8') as file:
+        file.write(json.dumps(item, ensure_ascii=False) + '\n')
+        file.flush()
+        os.fsync(file.fileno())
+
+
+def unpack_manifest(path, repo_root, v8unpack, enterpriseVersion,
+                    manifest, shard=None):
+
+    if not os.path.exists(manifest):
+        print(f'..Составляем список обработок "{manifest}".')
+        write_manifest(manifest, epf_manifest(path, repo_root))
+
+    index, count = shard or (1, 1)
+
+    items = [x for x in read_manifest(manifest)
+             if shard_of(x['epf'], count) == index - 1]
+
+    journal = f'{manifest}.{index}-{count}.journal'
+    finished = read_journal(journal)
+    todo = [x for x in items if finished.get(x['epf']) != x['hash']]
+
+    print(f'..Часть {index}/{count}: обработок {len(items)},'
+          f' уже разобрано {len(items) - len(todo)}.')
+
+    for item in todo:
+        epf = os.path.join(repo_root, item['epf'])
+
+        if file_hash(epf) != item['hash']:
+            raise Exception(f'Обработка "{epf}" изменилась'
+                            ' после составления списка')
+
+        unpack(epf=epf,
+               xml=os.path.join(repo_root, item['xml']),
+               v8unpack=v8unpack,
+               enterpriseVersion=enterpriseVersion)
+
+        append_journal(journal, item)
+
+
+def merge_shards(manifest, shard_roots, repo_root):
+
+    # Собирает исходники, разобранные по частям, в один репозиторий.
+    # shard_roots - корни частей по порядку: 1/N, 2/N, ...
+
+    count = len(shard_roots)
+    missing = []
+
+    for item in read_manifest(manifest):
+        shard_root = shard_roots[shard_of(item['epf'], count)]
+
+        if os.path.abspath(shard_root) == os.path.abspath(repo_root):
+            continue
+
+        srcXml = os.path.join(shard_root, item['xml'])
+
+        if not os.path.exists(srcXml):
+            missing.append(item['epf'])
+            continue
+
+        syncEpfSources(srcXml, os.path.join(repo_root, item['xml']))
+
+    if missing:
+        raise Exception('Нет исходников обработок: ' + ', '.join(missing))
+
+    print(f'..Объединено частей: {count}.')
+
+class EpfWatcher:
+
+    # Держит подготовленную к сборке копию исходников обработки,
+    # при изменении файлов пересобирает только затронутые формы
+
+    def __init__(self, epf, xml, v8unpack, enterprise, infobase, stagingDir):
+
+        self.epf = epf
+        self.xml = xml
+        self.root = enterprise.getEpfDumpRoot(xml)
+
+        self._v8unpack = v8unpack
+        self._enterprise = enterprise
+        self._infobase = infobase
+        self._stagingXml = os.path.join(stagingDir, os.path.basename(xml))
+        self._stagingRoot = enterprise.getEpfDumpRoot(self._stagingXml)
+        self._files = {}
+
+    def _snapshot(self):
+
+        result = {}
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            for filename in filenames:
+                filePath = os.path.join(dirpath, filename)
+                stat = os.stat(filePath)
+                result[filePath] = (stat.st_mtime_ns, stat.st_size)
+
+        stat = os.stat(self.xml)
+        result[self.xml] = (stat.st_mtime_ns, stat.st_size)
+
+        return result
+
+    def _stagingPath(self, filePath):
+
+        if filePath == self.xml:
+            return self._stagingXml
+
+        relPath = os.path.relpath(filePath, self.root)
+        return os.path.join(self._stagingRoot, relPath)
+
+    def _packForms(self, formDirs, pool):
+
+        srcForms = []
+        for formDir in formDirs:
+            stagingDir = self._stagingPath(formDir)
+            os.makedirs(stagingDir, exist_ok=True)
+            for file in ['form.prettydata', 'module.bsl']:
+                filePath = os.path.join(formDir, file)
+                if os.path.exists(filePath):
+                    shutil.copyfile(filePath, os.path.join(stagingDir, file))
+            srcForms.append(os.path.join(stagingDir, 'form.prettydata'))
+
+        FormScheduler(pool).run(
+            packForms, [(form, self._v8unpack) for form in srcForms])
+
+    def prepare(self, pool):
+
+        self._files = self._snapshot()
+
+        shutil.copyfile(self.xml, self._stagingXml)
+        copy_tree(self.root, self._stagingRoot)
+
+        formDirs = [os.path.dirname(x)
+                    for x in findFiles(self.root, 'form.prettydata')]
+        self._packForms(formDirs, pool)
+
+    def changes(self):
+
+        files = self._snapshot()
+
+        changed = [x for x in files if self._files.get(x) != files[x]]
+        removed = [x for x in self._files if x not in files]
+
+        self._files = files
+
+        return changed, removed
+
+    def rebuild(self, changed, removed, pool):
+
+        for filePath in removed:
+            stagingPath = self._stagingPath(filePath)
+            if os.path.exists(stagingPath):
+                os.remove(stagingPath)
+            # Форма удалена целиком - уберем и результаты ее сборки
+            if not os.path.exists(os.path.dirname(filePath)):
+                shutil.rmtree(os.path.dirname(stagingPath),
+                              ignore_errors=True)
+
+        formDirs = set()
+        for filePath in changed:
+            formDir = os.path.dirname(filePath)
+            if os.path.exists(os.path.join(formDir, 'form.prettydata')):
+                formDirs.add(formDir)
+            else:
+                stagingPath = self._stagingPath(filePath)
+                os.makedirs(os.path.dirname(stagingPath), exist_ok=True)
+                shutil.copyfile(filePath, stagingPath)
+
+        if formDirs:
+            print(f'..Восстанавливаем обычные формы: {len(formDirs)}.')
+            self._packForms(formDirs, pool)
+
+        print(f'..Создаем обработку "{self.epf}" из "{self.xml}".')
+
+        if os.path.exists(self.epf):
+            os.remove(self.epf)
+
+        self._enterprise.epfBuid(self._stagingXml, self.epf, self._infobase)
+
+
+def watch(path, v8unpack, enterpriseVersion=None, interval=1.0):
+
+    Enterprise = EnterpriseManager(enterpriseVersion)
+
+    estimate = 2 * treeSize(os.path.join(path, 'src'))
+
+    # Информационная база создается один раз на весь сеанс
+
+    with scratch().directory('watch-', estimate) as tempdir, \
+            Enterprise.tempInfobase() as INFOBASE, Pool() as pool:
+
+        watchers = {}
+
+        def addWatchers():
+
+            # Обработки ищем заново при каждом опросе: новые тоже
+            # попадают под наблюдение
 
-        else:
-            with Pool() as pool:
-                pool.starmap(packForms, zip(
-                    srcForms, itertools.repeat(v8unpack)))
+            count = len(watchers)
 
-        # Собрать исходники в epf
-        print(f'..Создаем обработку "{epf}" из "{xml}".')
+            for epf in findFiles(path, '*.epf'):
+                if epf in watchers:
+                    continue
+                xml = getXmlpathForEpf(epf, path)
+                if not os.path.exists(xml):
+                    continue
 
-        Enterprise.epfBuid(xml, epf)
+                stagingDir = os.path.join(tempdir, str(len(watchers)))
+                os.makedirs(stagingDir)
 
-        print('..Успешно завершено')
+                print(f'..Готовим окружение для "{epf}".', end="\r")
+                watcher = EpfWatcher(epf, xml, v8unpack, Enterprise,
+                                     INFOBASE, stagingDir)
+                watcher.prepare(pool)
+                watchers[epf] = watcher
 
+            if len(watchers) != count:
+                print(f'..Наблюдаем за исходниками обработок: {len(watchers)}.'
+                      ' Для выхода нажмите Ctrl+C.')
 
-def unpack(epf, xml, v8unpack, enterpriseVersion=None):
+        addWatchers()
+        if not watchers:
+            print('..Наблюдаем за исходниками обработок: 0.'
+                  ' Для выхода нажмите Ctrl+C.')
 
-    print(f'..Разбираем обработку "{epf}" в "{xml}".')
+        try:
+            while True:
+                time.sleep(interval)
+                addWatchers()
+                for watcher in watchers.values():
+                    changed, removed = watcher.changes()
+                    if not changed and not removed:
+                        continue
 
-    # Выгрузка обработки в XML формат
+                    start = time.monotonic()
+                    try:
+                        watcher.rebuild(changed, removed, pool)
+                    except Exception as error:
+                        print(f'..Не удалось собрать "{watcher.epf}": {error}')
+                    else:
+                        print(f'..Обработка "{watcher.epf}" собрана'
+                              f' за {time.monotonic() - start:.1f} с.')
 
-    Enterprise = EnterpriseManager(enterpriseVersion)
-    Enterprise.epfDump(epf, xml)
+        except KeyboardInterrupt:
+            print('..Наблюдение остановлено.')
 
-    # Распаковка обычных форм в исходники в "Своем формата"
 
-    binariesForms = findFiles(Enterprise.getEpfDumpRoot(xml), 'Form.bin')
+def precommit(path, v8unpack, enterpriseVersion=None, jobs=None):
 
-    print('..Разбираем обычные формы.', end="\r")
+    # Рабочий каталог процесса не меняем: все пути и команды git
+    # строятся от каталога проекта
+    path = os.path.abspath(path or '.')
 
-    with Pool() as pool:
-        pool.starmap(unpackForms, zip(
-            binariesForms, itertools.repeat(v8unpack)))
+    # Сравним состояние репозитория с индексированными файлами
+    status = GitStatus(path)
+    index = git_index_entries(path)
 
-    with Pool() as pool:
-        pool.map(afterUnpackForms, binariesForms)
+    with repoCatalog(path, index) as catalog:
 
-    print(
-        f'..Успешно завершено. Обработано: {len(binariesForms)} обычных форм.')
+        # Проверим, это может быть мерж
+        if status.itsmerge:
+            precommit_merge(path, v8unpack, enterpriseVersion, status, jobs,
+                            index, catalog)
 
+        else:
+            precommit_parse(path, v8unpack, enterpriseVersion, status, jobs,
+                            index, catalog)
 
-def findFiles(path, mask, mask_ignore=".git/"):
+    print('..Успешно завершено.')
 
-    result = []
 
-    for i in pathlib.Path(path).rglob(mask):
-        if mask_ignore not in str(i):
-            result.append(str(i))
+def precommit_jobs(jobs=None):
 
-    return result
+    # Сеанс конфигуратора тяжелый, по умолчанию занимаем половину ядер
 
+    if jobs is None:
+        jobs = (os.cpu_count() or 2) // 2
 
-def unpack_all(path, repo_root, v8unpack, enterpriseVersion=None):
+    return max(jobs, 1)
 
-    # Найдем все обработки
 
-    mask = "*.epf"
-    epf_list = findFiles(path, mask)
+def precommit_run(func, epf_list, jobs):
 
-    # Разберем все обработки
+    # Выполняет func(epf, pool) для всех обработок одновременно,
+    # не более jobs процессов платформы, общий пул для форм.
+    # Возвращает список успешно обработанных и словарь ошибок
 
-    for epf in epf_list:
-        xml = getXmlpathForEpf(epf, repo_root)
-        unpack(epf=epf,
-               xml=xml,
-               v8unpack=v8unpack,
-               enterpriseVersion=enterpriseVersion)
+    done = []
+    errors = {}
 
+    def run(epf):
+        try:
+            func(epf, pool)
+        except Exception as error:
+            errors[epf] = error
+        else:
+            done.append(epf)
 
-def precommit(path, v8unpack, enterpriseVersion=None):
+    with Pool() as pool, ThreadPool(precommit_jobs(jobs)) as platform:
+        platform.map(run, epf_list)
 
-    # Если указана директория каталога проекта, то сменим рабочую директорию
-    if path is not None:
-        os.chdir(path)
+    return [x for x in epf_list if x in done], errors
 
-    # Сравним состояние репозитория с индексированными файлами
-    status = GitStatus()
 
-    # Проверим, это может быть мерж
-    if status.itsmerge:
-        precommit_merge(path, v8unpack, enterpriseVersion, status)
+def precommit_report(done, errors):
 
-    else:
-        precommit_parse(path, v8unpack, enterpriseVersion, status)
+    print(f'..Обработано: {len(done)}, с ошибками: {len(errors)}.')
 
-    print('..Успешно завершено.')
+    for epf, error in errors.items():
+        print(f'..Ошибка "{epf}": {error}')
 
+    if errors:
+        raise Exception('Не удалось обработать: ' + ', '.join(errors))
 
-def precommit_parse(path, v8unpack, enterpriseVersion, status):
 
-    # Интересует список только измененных обработок
-    epf_list = [x for x in status.A + status.M if x.endswith(".epf")]
+def precommit_parse(path, v8unpack, enterpriseVersion, status, jobs=None,
+                    index=None, catalog=None):
+
+    # Интересует список только измененных в индексе обработок
+    staged = [x for x in status.staged if x.endswith(".epf")]
+    epf_list = [os.path.join(path, x) for x in staged]
 
     if not epf_list:
 
         print('..Нет измененных/новых обработок в индексе.')
         return
 
+    if index is None:
+        index = git_index_entries(path)
+    if catalog is None:
+        with repoCatalog(path, index) as catalog:
+            precommit_parse(path, v8unpack, enterpriseVersion, status, jobs,
+                            index, catalog)
+        return
+
+    # Разбираем только то, что есть в индексе: без записи индекса
+    # (например, конфликт слияния) рабочий каталог не подставляем
+
+    missing = [x for x in staged if x not in index]
+    if missing:
+        raise Exception('Нет в индексе (не разрешен конфликт?): ' +
+                        ', '.join(missing))
+
+    objects = {os.path.join(path, x): index[x] for x in staged}
+
     # Разбор на исходники всех обработок
     print('..Разбираем обработки на исходники.')
-    for epf in epf_list:
-        xml = getXmlpathForEpf(epf, path)
-        unpack(
-            epf=epf,
-            xml=xml,
-            v8unpack=v8unpack,
-            enterpriseVersion=enterpriseVersion
-        )
 
-        # Индексируем новые исходники
+    # Разбираем то, что в индексе, а не в рабочем каталоге:
+    # обработку могли проиндексировать и изменить после этого
+
+    with GitBlobReader(path) as reader:
+
+        def parse(epf, pool):
+            buffer = reader.read(objects[epf])
+
+            # Объект в индексе без фильтров (LFS, clean/smudge) - это
+            # указатель или очищенный текст, а не контейнер: читаем с
+            # фильтрами отдельно (--batch --filters не принимает пути
+            # из индекса в старых git)
+            if buffer is not None and not isV8Container(buffer):
+                buffer = git_file_content(epf, '', path)
+
+            if buffer is None:
+                raise Exception(f'Не удалось прочитать из индекса "{epf}"')
+
+            unpack(
+                epf=epf,
+                xml=catalog.xml(epf),
+                v8unpack=v8unpack,
+                enterpriseVersion=enterpriseVersion,
+                pool=pool,
+                buffer=buffer
+            )
+
+        done, errors = precommit_run(parse, epf_list, jobs)
+
+    # Индексируем новые исходники
+    if done:
         print('..Добавляем файлы в индекс.')
-        dirPath = os.path.dirname(xml)
-        git_add(dirPath)
+        git_add([os.path.dirname(catalog.xml(x)) for x in done], path)
+
+    precommit_report(done, errors)
 
 
-def precommit_merge(path, v8unpack, enterpriseVersion, status):
+def precommit_merge(path, v8unpack, enterpriseVersion, status, jobs=None,
+                    index=None, catalog=None):
+
+    # Обработки, к исходникам которых относятся изменения, - по каталогу
+    if catalog is None:
+        with repoCatalog(path, index) as catalog:
+            precommit_merge(path, v8unpack, enterpriseVersion, status, jobs,
+                            index, catalog)
+        return
 
-    # Найдем все обработки в репо
-    epf_in_repo_list = git_epf_in_repo(path)
     epf_build_list = []
+    epf_changes = {}
 
-    for new in status.A + status.M:
-        for epf in epf_in_repo_list:
+    changes = [(kind, file)
+               for kind in ['A', 'M', 'D', 'R']
+               for file in getattr(status, kind)]
 
-            srcPath = os.path.abspath(getSrcRootpathForEpf(epf, path))
-            filePath = os.path.abspath(new)
+    for kind, new in changes:
+        filePath = os.path.abspath(os.path.join(path, new))
+        epf = catalog.owner(filePath)
+        if epf is None:
+            continue
 
-            if srcPath in filePath and not epf in epf_build_list:
-                epf_build_list.append(epf)
+        epf_changes.setdefault(epf, []).append((kind, filePath))
+
+        if kind in 'AM' and not epf in epf_build_list:
+            epf_build_list.append(epf)
 
     if not epf_build_list:
 
@@ -927,18 +5050,30 @@ def precommit_merge(path, v8unpack, enterpriseVersion, status):
         return
 
     print('..Собираем обработки из исходников после мержа.')
-    for epf in epf_build_list:
-        xml = getXmlpathForEpf(epf, path)
+
+    def merge(epf, pool):
+        xml = catalog.xml(epf)
+
+        # Изменились только модули - заменяем их в epf без конфигуратора
+        if patchEpfModules(epf, xml, epf_changes[epf], path):
+            return
+
         build(
             epf=epf,
             xml=xml,
             v8unpack=v8unpack,
-            enterpriseVersion=enterpriseVersion
+            enterpriseVersion=enterpriseVersion,
+            pool=pool
         )
 
-        # Индексируем новые собранные epf
+    done, errors = precommit_run(merge, epf_build_list, jobs)
+
+    # Индексируем новые собранные epf
+    if done:
         print('..Добавляем файлы в индекс.')
-        git_add(epf)
+        git_add(done, path)
+
+    precommit_report(done, errors)
 
 
 def getXmlpathForEpf(epf, path):
@@ -967,30 +5102,182 @@ def getSrcRootpathForEpf(epf, path):
     return srcRoot
 
 
-def git_add(path=None):
+def git_add(path, repo_root=None):
 
-    CmdStr = f'git add {path}'
-    result = os.system(CmdStr)
-    if result != 0:
+    # path - путь или список путей
+
+    if isinstance(path, str):
+        path = [path]
+
+    if not repo_root:
+        repo_root = os.getcwd()
+
+    cmd = ['git', '-C', repo_root, 'add', '--'] + list(path)
+    result = subprocess.run(cmd)
+    if result.returncode != 0:
         raise Exception('Не удалось проиндексировать новые файлы')
 
-def git_epf_in_repo(path=None):
 
-    cmd = "git ls-files --cached -- *.epf"
+def git_file_content(path, rev='HEAD', repo_root=None):
+
+    # Содержимое файла в ревизии (rev='' - в индексе) с фильтрами рабочего
+    # каталога (переводы строк), None - файла там нет
+
+    if not repo_root:
+        repo_root = os.getcwd()
+
+    relPath = pathlib.Path(os.path.relpath(path, repo_root)).as_posix()
+    cmd = ['git', '-C', repo_root, 'cat-file', '--filters',
+           f'{rev}:{relPath}']
+    result = subprocess.run(cmd, stdout=subprocess.PIPE,
+                            stderr=subprocess.DEVNULL)
+
+    return result.stdout if result.returncode == 0 else None
+
+
+def git_dir(path=None):
+
+    # Абсолютный путь каталога .git, None - не репозиторий
+
+    if not path:
+        path = os.getcwd()
+    cmd = ['git', '-C', path, 'rev-parse', '--absolute-git-dir']
+    result = subprocess.run(cmd, stdout=subprocess.PIPE,
+                            stderr=subprocess.DEVNULL)
+    if result.returncode != 0:
+        return None
+    return result.stdout.decode('utf-8').strip()
+
+
+def git_ignored_epfs(path=None):
+
+    # Обработки среди игнорируемых файлов от каталога проекта. Их нет
+    # в каталоге репозитория, а обход дерева их всегда находил.
+    # Игнорируемый каталог git отдает целиком - обходим только его
+
+    if not path:
+        path = os.getcwd()
+    cmd = ['git', '-C', path, 'ls-files', '--others', '--ignored',
+           '--exclude-standard', '--directory', '-z']
+    returned_output = subprocess.check_output(cmd)
+
+    result = []
+    for name in returned_output.split(b'\0'):
+        name = name.decode('utf-8')
+        if name.endswith('/'):
+            result.extend(findFiles(os.path.join(path, name), '*.epf'))
+        elif name.endswith('.epf'):
+            result.append(os.path.normpath(os.path.join(path, name)))
+    return result
+
+
+def git_untracked(path=None, pattern=None):
+
+    # Неотслеживаемые и не игнорируемые файлы от каталога проекта
+
+    if not path:
+        path = os.getcwd()
+    cmd = ['git', '-C', path, 'ls-files', '--others', '--exclude-standard',
+           '-z']
+    if pattern is not None:
+        cmd = cmd + ['--', pattern]
+    returned_output = subprocess.check_output(cmd)
+    return [x.decode('utf-8') for x in returned_output.split(b'\0') if x]
+
+
+def git_index_entries(path=None):
+
+    # Файлы индекса от каталога проекта и id их объектов,
+    # одним вызовом `git ls-files`. Неразрешенные конфликты пропускаются
+
+    if not path:
+        path = os.getcwd()
+    cmd = ['git', '-C', path, 'ls-files', '--stage', '-z']
     returned_output = subprocess.check_output(cmd)
-    out = returned_output.decode("utf-8")
-    return out.splitlines()
+
+    entries = {}
+    for record in returned_output.split(b'\0'):
+        if not record:
+            continue
+        info, name = record.split(b'\t', 1)
+        mode, objectId, stage = info.split()
+        if stage == b'0':
+            entries[name.decode('utf-8')] = objectId.decode('ascii')
+
+    return entries
+
+
+class GitBlobReader:
+
+    # Объекты git через один процесс `git cat-file --batch`
+    # на все чтения, можно читать из нескольких потоков
+
+    def __init__(self, path=None):
+        if not path:
+            path = os.getcwd()
+        cmd = ['git', '-C', path, 'cat-file', '--batch']
+        self._process = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE)
+        self._lock = threading.Lock()
+
+    def read(self, name):
+
+        # Содержимое объекта (id или <ревизия>:<путь>), None - нет такого
+
+        with self._lock:
+            self._process.stdin.write(name.encode('utf-8') + b'\n')
+            self._process.stdin.flush()
+
+            header = self._process.stdout.readline().split()
+            if len(header) != 3:
+                return None
+
+            data = self._process.stdout.read(int(header[2]))
+            self._process.stdout.read(1)
+
+        return data
+
+    def close(self):
+
+        self._process.stdin.close()
+        self._process.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
 
 def get_status(path=None):
 
-    # Возвращает `git status` строку
+    # Возвращает записи `git status`: (XY, путь, прежний путь или None).
+    # С -z пути не заключаются в кавычки и не экранируются, но идут от
+    # корня репозитория - переводим их от каталога path, как в `-s`
 
     if not path:
         path = os.getcwd()
-    cmd = "git status -s"
+    cmd = ['git', '-C', path, 'rev-parse', '--show-toplevel']
+    top = subprocess.check_output(cmd).decode('utf-8').strip()
+    cmd = ['git', '-C', path, 'status', '--porcelain', '-z']
     returned_output = subprocess.check_output(cmd)
-    out = returned_output.decode("utf-8")
-    return out
+
+    def relative(name):
+        name = os.path.join(top, name.decode('utf-8'))
+        return pathlib.Path(os.path.relpath(name, path)).as_posix()
+
+    entries = []
+    records = iter(returned_output.split(b'\0'))
+    for record in records:
+        if not record:
+            continue
+        status = record[0:2].decode('ascii')
+        origPath = None
+        if status[0] in 'RC':
+            origPath = relative(next(records))
+        entries.append((status, relative(record[3:]), origPath))
+
+    return entries
 
 
 class GitStatus:
@@ -1009,16 +5296,13 @@ class GitStatus:
 
     def _startswith(self, string):
         """return list of files startswith string"""
-        lines = []
-        for line in self.out.splitlines():
-            index = 4 - len(string)
-            if line.startswith(string):
-                lines.append(line.split(" ")[index])
-        return lines
+        return [name for status, name, origPath in self.out
+                if status.startswith(string)]
 
     def _itsmerge(self):
 
-        cmd = "git rev-parse -q --verify MERGE_HEAD"
+        cmd = ['git', '-C', self.path, 'rev-parse', '-q', '--verify',
+               'MERGE_HEAD']
         result = subprocess.run(cmd, stdout=subprocess.PIPE)
 
         return result.returncode == 0
@@ -1043,6 +5327,13 @@ class GitStatus:
         """return list of renamed files"""
         return self._startswith("R ")
 
+    @property
+    def staged(self):
+        """return list of added or modified files in the index,
+        including files changed again after staging"""
+        return [name for status, name, origPath in self.out
+                if status[0] in 'AM']
+
     @property
     def UU(self):
         """return list of unresolved files"""
@@ -1111,6 +5402,58 @@ def parse_args():
         help='Версия 1С:Предприятие'
     )
 
+    parser.add_argument(
+        '--cache-dir',
+        help='Каталог кэша разобранных форм, пустая строка отключает кэш'
+    )
+
+    parser.add_argument(
+        '--scratch',
+        help='Каталог для временных файлов (базы, логи, копии исходников),'
+        ' по умолчанию tmpfs, если есть'
+    )
+
+    parser.add_argument(
+        '--scratch-size',
+        type=int,
+        help='Сколько МБ можно занять в каталоге временных файлов,'
+        ' остальное пишется в обычный временный каталог'
+    )
+
+    parser.add_argument(
+        '--scratch-cleanup',
+        choices=SCRATCH_CLEANUP,
+        help='Удалять временные каталоги всегда (always)'
+        ' или только после успешных операций (success)'
+    )
+
+    parser.add_argument(
+        '--scratch-keep',
+        action='store_true',
+        help='Сохранять временные информационные базы между запусками'
+    )
+
+    parser.add_argument(
+        '--memory-budget',
+        type=int,
+        help='Сколько МБ памяти можно занять формами одновременно,'
+        ' по умолчанию половина памяти машины'
+    )
+
+    parser.add_argument(
+        '--designer-fatal',
+        action='append',
+        help='Регулярное выражение для строки лога конфигуратора, после'
+        ' которой он останавливается с ошибкой (можно несколько),'
+        ' в дополнение к стандартным'
+    )
+
+    parser.add_argument(
+        '--profile',
+        help='Каталог для профиля запуска: profile.pstats и'
+        ' profile.collapsed по всем процессам'
+    )
+
     parser.add_argument(
         '--v8unpack',
         help='Путь до утилиты V8Unpack',
@@ -1160,8 +5503,47 @@ def parse_args():
         help='Путь к директории, в которую выгрузить исходники'
     )
 
+    parse_all_command.add_argument(
+        "--manifest",
+        help='Файл со списком обработок, создается при отсутствии'
+    )
+
+    parse_all_command.add_argument(
+        "--shard",
+        help='Разобрать только часть i из N списка, например 1/4',
+        type=parse_shard
+    )
+
     parse_all_command.set_defaults(func=parse_all_in)
 
+    # merge-shards
+    merge_shards_command = subparsers.add_parser(
+        "merge-shards",
+        help='Объединяет исходники, разобранные по частям'
+    )
+
+    merge_shards_command.add_argument(
+        "--manifest",
+        help='Файл со списком обработок',
+        required=True,
+        type=check_input_file
+    )
+
+    merge_shards_command.add_argument(
+        "--repo-root",
+        default=".",
+        help='Путь к репозиторию, в который собрать исходники'
+    )
+
+    merge_shards_command.add_argument(
+        "shards",
+        nargs='+',
+        help='Корни репозиториев частей по порядку: 1/N, 2/N, ...'
+    )
+
+    merge_shards_command.set_defaults(func=merge_shards_in,
+                                      v8unpack_required=False)
+
     # build
     build_command = subparsers.add_parser(
         "build",
@@ -1197,8 +5579,150 @@ def parse_args():
         help="Путь к каталогу проекта"
     )
 
+    precommit_command.add_argument(
+        "--jobs",
+        type=int,
+        help="Количество одновременно запускаемых конфигураторов"
+    )
+
     precommit_command.set_defaults(func=precommit_in)
 
+    # watch
+    watch_command = subparsers.add_parser(
+        "watch",
+        help='Следит за исходниками обработок в каталоге проекта'
+        ' и пересобирает измененные обработки'
+    )
+
+    watch_command.add_argument(
+        "--path",
+        default=".",
+        help="Путь к каталогу проекта"
+    )
+
+    watch_command.add_argument(
+        "--interval",
+        default=1.0,
+        type=float,
+        help="Период проверки изменений, секунд"
+    )
+
+    watch_command.set_defaults(func=watch_in)
+
+    # stats
+    stats_command = subparsers.add_parser(
+        "stats",
+        help='Показывает время запусков по истории:'
+        ' процентили по командам и этапам, замедления'
+    )
+
+    stats_command.add_argument(
+        "--command",
+        dest="run_command",
+        help="Показать только запуски этой команды"
+    )
+
+    stats_command.add_argument(
+        "--window",
+        type=int,
+        default=10,
+        help="Сколько последних запусков сравнивать с предыдущими"
+    )
+
+    stats_command.add_argument(
+        "--threshold",
+        type=float,
+        default=20,
+        help="Замедление медианы в процентах, о котором сообщать"
+    )
+
+    stats_command.set_defaults(func=stats_in, v8unpack_required=False,
+                               history=False)
+
+    # verify-corpus
+    verify_corpus_command = subparsers.add_parser(
+        "verify-corpus",
+        help='Проверяет, что чтение и запись всех форм в каталоге'
+        ' побайтно сохраняют form.data и form.prettydata'
+    )
+
+    verify_corpus_command.add_argument(
+        "path",
+        help="Каталог с формами"
+    )
+
+    verify_corpus_command.add_argument(
+        "--jobs",
+        type=int,
+        help="Количество процессов, по умолчанию по числу ядер"
+    )
+
+    verify_corpus_command.add_argument(
+        "--max-failures",
+        type=int,
+        default=10,
+        help="Прервать проверку после стольких ошибок, 0 - не прерывать"
+    )
+
+    verify_corpus_command.add_argument(
+        "--report",
+        help="Файл для результатов по каждой форме (JSON по строке)"
+    )
+
+    verify_corpus_command.set_defaults(func=verify_corpus_in,
+                                       v8unpack_required=False)
+
+    # merge-form
+    merge_form_command = subparsers.add_parser(
+        "merge-form",
+        help='Трехстороннее слияние обычной формы,'
+        ' подходит как merge driver git: merge-form %%O %%A %%B'
+    )
+
+    merge_form_command.add_argument(
+        "base",
+        help="Общий предок",
+        type=check_input_file
+    )
+
+    merge_form_command.add_argument(
+        "ours",
+        help="Наша версия, в нее записывается результат",
+        type=check_input_file
+    )
+
+    merge_form_command.add_argument(
+        "theirs",
+        help="Их версия",
+        type=check_input_file
+    )
+
+    merge_form_command.add_argument(
+        "--output",
+        help="Файл результата вместо ours"
+    )
+
+    merge_form_command.set_defaults(func=merge_form_in,
+                                    v8unpack_required=False)
+
+    # diff-form
+    diff_form_command = subparsers.add_parser(
+        "diff-form",
+        help='Структурное сравнение обычной формы по веткам, подходит'
+        ' как diff driver git (7 аргументов: путь, старый файл, хэш,'
+        ' режим, новый файл, хэш, режим)'
+    )
+
+    diff_form_command.add_argument(
+        "files",
+        nargs='+',
+        help="Старая и новая версии формы или аргументы git"
+    )
+
+    diff_form_command.set_defaults(func=diff_form_in,
+                                   v8unpack_required=False,
+                                   history=False)
+
     return parser.parse_args()
 
 
@@ -1215,7 +5739,16 @@ def parse_all_in(args):
     unpack_all(path=args.path,
                repo_root=args.repo_root,
                v8unpack=args.v8unpack,
-               enterpriseVersion=args.enterpriseVersion)
+               enterpriseVersion=args.enterpriseVersion,
+               manifest=args.manifest,
+               shard=args.shard)
+
+
+def merge_shards_in(args):
+
+    merge_shards(manifest=args.manifest,
+                 shard_roots=args.shards,
+                 repo_root=args.repo_root)
 
 
 def build_in(args):
@@ -1230,11 +5763,97 @@ def precommit_in(args):
 
     precommit(path=args.path,
               v8unpack=args.v8unpack,
-              enterpriseVersion=args.enterpriseVersion)
+              enterpriseVersion=args.enterpriseVersion,
+              jobs=args.jobs)
+
+
+def watch_in(args):
+
+    watch(path=args.path,
+          v8unpack=args.v8unpack,
+          enterpriseVersion=args.enterpriseVersion,
+          interval=args.interval)
+
+
+def merge_form_in(args):
+
+    conflicts = mergeForms(base=args.base,
+                           ours=args.ours,
+                           theirs=args.theirs,
+                           output=args.output)
+
+    for conflict in conflicts:
+        print(f'..Конфликт: {conflict}')
+
+    if conflicts:
+        sys.exit(1)
+
+
+def diff_form_in(args):
+
+    # git передает: путь, старый файл, хэш, режим, новый файл, хэш,
+    # режим, а при переименовании еще новый путь и описание
+
+    files = args.files
+    if len(files) == 2:
+        old, new = files
+        oldName, newName = old, new
+    elif len(files) in (7, 9):
+        old, new = files[1], files[4]
+        oldName = files[0]
+        newName = files[7] if len(files) == 9 else files[0]
+    else:
+        raise Exception('diff-form: нужны два файла'
+                        ' или аргументы diff driver git')
+
+    printFormDiff(diffForms(old, new), oldName.replace('\\', '/'),
+                  newName.replace('\\', '/'))
+
+
+def stats_in(args):
+
+    printHistoryStats(historyStats(readHistory(),
+                                   command=args.run_command,
+                                   window=args.window,
+                                   threshold=args.threshold / 100))
+
+
+def verify_corpus_in(args):
+
+    failures = verifyCorpus(path=args.path,
+                            jobs=args.jobs,
+                            maxFailures=args.max_failures,
+                            report=args.report)
+
+    if failures:
+        sys.exit(1)
 
 
 def validate_args(args):
 
+    if args.cache_dir is not None:
+        os.environ[CACHE_DIR_ENV] = args.cache_dir
+
+    if args.memory_budget is not None:
+        os.environ[MEMORY_BUDGET_ENV] = str(args.memory_budget * 1024 * 1024)
+
+    if args.designer_fatal:
+        for pattern in args.designer_fatal:
+            re.compile(pattern)
+        os.environ[DESIGNER_FATAL_ENV] = '\n'.join(args.designer_fatal)
+
+    if args.scratch is not None:
+        os.environ[SCRATCH_DIR_ENV] = args.scratch
+    if args.scratch_size is not None:
+        os.environ[SCRATCH_SIZE_ENV] = str(args.scratch_size * 1024 * 1024)
+    if args.scratch_cleanup is not None:
+        os.environ[SCRATCH_CLEANUP_ENV] = args.scratch_cleanup
+    if args.scratch_keep:
+        os.environ[SCRATCH_KEEP_ENV] = '1'
+
+    if not getattr(args, 'v8unpack_required', True):
+        return
+
     path = None
 
     if hasattr(args, 'path'):
@@ -1263,7 +5882,45 @@ def main():
 
     args = parse_args()
     validate_args(args)
-    args.func(args)
+
+    # Профиль пишет каждый процесс, сливаем после завершения команды
+    profiler = None
+    if args.profile is not None:
+        os.environ[PROFILE_DIR_ENV] = os.path.abspath(args.profile)
+        shutil.rmtree(os.path.join(args.profile, 'parts'),
+                      ignore_errors=True)
+        profiler = processProfiler()
+
+    if getattr(args, 'history', True):
+        runStart(args.command,
+                 path=getattr(args, 'path', None),
+                 epf=getattr(args, 'epf', None))
+
+    try:
+        if profiler is not None:
+            profiler.run(args.func, args)
+        else:
+            args.func(args)
+    except SystemExit as error:
+        # Код выхода - результат команды (конфликты merge-form, ошибки
+        # verify-corpus), а не сбой. Сбой - выход с сообщением
+        if error.code is None or isinstance(error.code, int):
+            runSet('exitCode', error.code or 0)
+            runFinish()
+        else:
+            runFinish(error)
+        raise
+    except BaseException as error:
+        runFinish(error)
+        raise
+    else:
+        runFinish()
+    finally:
+        if profiler is not None:
+            profiler.sampler.stop()
+            mergeProfiles(args.profile)
+
+    scratch().report()
 
 
 if __name__ == '__main__':